@@ -0,0 +1,117 @@
+""" Benchmark the nutritional code on synthetic data, run it as `python benchmark.py` """
+import contextlib
+import io
+import os
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+from diet import NUMERIC_COLUMNS, Day, MealPlan, NutritionalTable, Person, PersonTable
+
+PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dataframe.csv')
+MEALS = ['breakfast', 'lunch', 'dinner']
+
+def synthetic_records(table, people, days, foods_per_meal, seed=42):
+    """ Create a dataframe of random (person, day, meal, food, quantity) records """
+    rng = np.random.default_rng(seed)
+    records = pd.MultiIndex.from_product([[f'person_{i}' for i in range(people)],
+                                          range(days),
+                                          MEALS,
+                                          range(foods_per_meal)],
+                                         names=['person', 'day', 'meal', 'slot']).to_frame(index=False)
+    records['food'] = rng.choice(table.foods, len(records))
+    records['quantity'] = rng.integers(1, 200, len(records))
+    return records.drop(columns='slot')
+
+def per_day(records, table):
+    """ Evaluate the records the old way, one Day per person and day """
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _, day_records in records.groupby(['person', 'day'], sort=False):
+            day = Day()
+            for meal, meal_records in day_records.groupby('meal', sort=False):
+                day.adding_food(dict(zip(meal_records['food'], meal_records['quantity'])), table, meal)
+            day.summary()
+
+def batch(records, table, people):
+    """ Evaluate the records with a single MealPlan """
+    plan = MealPlan(records, table)
+    plan.evaluate()
+    plan.compare_tdee(people)
+
+def bench_meal_plan(people=1000, days=7, foods_per_meal=4, per_day_people=50):
+    table = NutritionalTable(PATH)
+    records = synthetic_records(table, people, days, foods_per_meal)
+    persons = [Person(name, 1990, 'M', 180, 80, 1.4) for name in records['person'].unique()]
+
+    start = time.perf_counter()
+    batch(records, table, persons)
+    batch_rate = len(records) / (time.perf_counter() - start)
+
+    # The per-Day path is slow, so only time a subset of the people
+    subset = records[records['person'].isin(records['person'].unique()[:per_day_people])]
+    start = time.perf_counter()
+    per_day(subset, table)
+    per_day_rate = len(subset) / (time.perf_counter() - start)
+
+    print(f"MealPlan: {batch_rate:,.0f} records/s ({len(records):,} records)")
+    print(f"Day:      {per_day_rate:,.0f} records/s ({len(subset):,} records)")
+    print(f"Speedup:  {batch_rate / per_day_rate:.1f}x")
+
+def synthetic_catalog(path, foods, seed=42):
+    """ Write a csv shaped like dataframe.csv, with comma decimals, for the given number of foods """
+    rng = np.random.default_rng(seed)
+    catalog = pd.DataFrame(rng.random((foods, len(NUMERIC_COLUMNS))) * 100, columns=NUMERIC_COLUMNS)
+    catalog.insert(0, 'state', 'de')
+    catalog.insert(0, 'item', [f'food_{i}' for i in range(foods)])
+    catalog.to_csv(path, index=False, decimal=',')
+
+def bench_startup(foods=50000, repeat=5):
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'catalog.csv')
+        synthetic_catalog(path, foods)
+        # The first load parses the csv and writes the cache
+        NutritionalTable(path)
+        for label, cache in [('csv parse', False), ('cache', True)]:
+            start = time.perf_counter()
+            for _ in range(repeat):
+                NutritionalTable(path, cache=cache)
+            print(f"{label}: {(time.perf_counter() - start) / repeat * 1000:.1f} ms per load ({foods:,} foods)")
+
+def bench_cohort(people=500000, per_person=20000, seed=42):
+    rng = np.random.default_rng(seed)
+    names = [f'person_{i}' for i in range(people)]
+    year = rng.integers(1940, 2006, people)
+    gender = rng.choice(['F', 'M'], people)
+    height = rng.integers(150, 200, people)
+    weight = rng.uniform(45, 120, people)
+    exercise = rng.choice([1.2, 1.375, 1.55, 1.725], people)
+
+    start = time.perf_counter()
+    cohort = PersonTable(names, year, gender, height, weight, exercise)
+    cohort_rate = people / (time.perf_counter() - start)
+
+    # Recompute bmr and tdee for the whole cohort, e.g. after switching formula
+    cohort.formula = 'mifflin_st_jeor'
+    start = time.perf_counter()
+    cohort.update()
+    recompute_rate = people / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for i in range(per_person):
+        Person(names[i], int(year[i]), str(gender[i]), int(height[i]), float(weight[i]), float(exercise[i]))
+    person_rate = per_person / (time.perf_counter() - start)
+
+    # Change the weight of 1% of the cohort
+    changed = names[::100]
+    start = time.perf_counter()
+    cohort.update_weight(changed, rng.uniform(45, 120, len(changed)))
+    update_time = time.perf_counter() - start
+
+    print(f"PersonTable: {cohort_rate:,.0f} people/s built, {recompute_rate:,.0f} people/s recomputed ({people:,} people)")
+    print(f"Person:      {person_rate:,.0f} people/s ({per_person:,} people)")
+    print(f"Weight update of {len(changed):,} people: {update_time * 1000:.1f} ms")
+
+if __name__ == '__main__':
+    bench_meal_plan()
+    bench_startup()
+    bench_cohort()
@@ -1,6 +1,19 @@
 import datetime
+import hashlib
+import json
+import os
+import numpy as np
 import pandas as pd
-import csv
+from scipy import sparse
+
+# Numeric columns of the nutritional database, and among them the nutrients per unit of food
+NUMERIC_COLUMNS = ['piece', 'gr/pack', 'kcal', 'fat', 'sat_fat', 'carb', 'sugar', 'fiber', 'protein', 'salt', 'price_per_pack']
+NUTRIENTS = ['kcal', 'fat', 'sat_fat', 'carb', 'sugar', 'fiber', 'protein', 'salt']
+LABELS = ['Kcal', 'Fat', 'Sat_Fat', 'Carbs', 'Sugars', 'Fibers', 'Proteins', 'Salt']
+# Columns of the records accepted by MealPlan
+RECORD_COLUMNS = ['person', 'day', 'meal', 'food', 'quantity']
+# Arrays of NutritionalTable saved in its binary cache
+CACHE_ARRAYS = ['foods', 'state', 'values']
 
 class Person:
     def __init__(self,
@@ -33,26 +46,210 @@ class Person:
             self.tdee = self.bmr * exercise
         else:
             self.tdee = tdee
-            
+
+
+def harris_benedict(male, weight, height, age, body_fat=None):
+    """ Harris-Benedict BMR, rounded as Person does """
+    return np.round(np.where(male,
+                             66 + (13.7 * weight) + (5 * height) - (6.8 * age),
+                             655 + (9.6 * weight) + (1.8 * height) - (4.7 * age)))
+
+def mifflin_st_jeor(male, weight, height, age, body_fat=None):
+    """ Mifflin-St Jeor BMR """
+    return (10 * weight) + (6.25 * height) - (5 * age) + np.where(male, 5, -161)
+
+def katch_mcardle(male, weight, height, age, body_fat=None):
+    """ Katch-McArdle BMR from the lean body mass, nan where the body fat is not known """
+    if body_fat is None:
+        return np.full(np.shape(weight), np.nan)
+    return 370 + 21.6 * weight * (1 - body_fat)
+
+# BMR formulas available to PersonTable
+FORMULAS = {
+    'harris_benedict': harris_benedict,
+    'mifflin_st_jeor': mifflin_st_jeor,
+    'katch_mcardle': katch_mcardle,
+}
+
+class PersonTable:
+    """ Store a whole cohort of people as columns, and compute their age, bmr and tdee at once """
+    __slots__ = ['names', 'index', 'year', 'male', 'height', 'weight', 'exercise', 'body_fat', 'formula', 'age', 'bmr', 'tdee']
+
+    def __init__(self,
+                 names,
+                 year,
+                 gender,
+                 height,
+                 weight,
+                 exercise,
+                 body_fat=None,
+                 formula='harris_benedict',
+                 today=None):
+        if formula not in FORMULAS:
+            raise ValueError(f"Unknown formula {formula!r}, choose one of {list(FORMULAS)}")
+        gender = np.asarray(gender)
+        if not np.isin(gender, ['F', 'M']).all():
+            raise ValueError("Gender must be either 'F' or 'M'")
+
+        self.names = np.asarray(names, dtype=str)
+        self.index = {name: row for row, name in enumerate(self.names.tolist())}
+        self.year = np.asarray(year, dtype=np.int64)
+        self.male = gender == 'M'
+        self.height = np.asarray(height, dtype=np.float64)
+        self.weight = np.array(weight, dtype=np.float64)
+        self.exercise = np.asarray(exercise, dtype=np.float64)
+        self.body_fat = None if body_fat is None else np.asarray(body_fat, dtype=np.float64)
+        self.formula = formula
+
+        # Take today's date once for the whole cohort
+        today = today or datetime.date.today()
+        self.age = today.year - self.year
+        self.bmr = np.empty(len(self.names))
+        self.tdee = np.empty(len(self.names))
+        self.update()
+
+    @classmethod
+    def from_persons(cls, persons, **kwargs):
+        """ Build the table from a list of Person, their bmr and tdee are recomputed with the chosen formula """
+        today = kwargs.pop('today', None) or datetime.date.today()
+        return cls([person.name for person in persons],
+                   [today.year - person.age for person in persons],
+                   [person.gender for person in persons],
+                   [person.height for person in persons],
+                   [person.weight for person in persons],
+                   [person.exercise for person in persons],
+                   today=today,
+                   **kwargs)
+
+    def __len__(self):
+        return len(self.names)
+
+    def update(self, rows=slice(None)):
+        """ Recompute bmr and tdee, for everybody or only for the given rows """
+        body_fat = None if self.body_fat is None else self.body_fat[rows]
+        self.bmr[rows] = FORMULAS[self.formula](self.male[rows], self.weight[rows], self.height[rows], self.age[rows], body_fat)
+        # Apply the activity multiplier
+        self.tdee[rows] = self.bmr[rows] * self.exercise[rows]
+
+    def update_weight(self, names, weights):
+        """ Set the new weight of some people, and recompute only their bmr and tdee """
+        rows = np.fromiter((self.index[name] for name in names), dtype=np.intp, count=len(names))
+        self.weight[rows] = weights
+        self.update(rows)
+
+    def to_frame(self):
+        """ Return the cohort as a dataframe indexed by name """
+        return pd.DataFrame({'age': self.age,
+                             'gender': np.where(self.male, 'M', 'F'),
+                             'height': self.height,
+                             'weight': self.weight,
+                             'exercise': self.exercise,
+                             'bmr': self.bmr,
+                             'tdee': self.tdee},
+                            index=pd.Index(self.names, name='person'))
+
 class NutritionalTable:
     """ Create a class for storing the nutritional database """
-    def __init__(self, path):       
-        # Define the path of the database
-        self.path = path      
-        # Create the nutritional empty dictionary
-        self.df = {}       
-        # Open the csv nutritional database
-        with open(self.path, 'r') as file:
-            csv_reader = csv.reader(file)         
-            # Skip the header
-            next(csv_reader)           
-            for row in csv_reader:              
-                # The index is the first item of the row
-                index = str(row[0])          
-                # The values are all the other value and replace comma
-                values = [value.replace(',', '.') for value in row[1:]]            
-                # Create the key value pair in the nutritional empty list
-                self.df[index] = values
+    def __init__(self, path, cache=True):
+        # Define the path of the database, and of the binary cache written next to it
+        self.path = path
+        self.cache_path = path + '.cache'
+        # Reload the parsed arrays from the cache when it is still valid, otherwise parse the csv
+        if not (cache and self._load_cache()):
+            self._parse()
+            if cache:
+                self._write_cache()
+        # The name -> row index map
+        self.index = {food: row for row, food in enumerate(self.foods.tolist())}
+        self._set_columns()
+
+    def _parse(self):
+        """ Parse the csv once, converting the comma decimals while reading """
+        dataframe = pd.read_csv(self.path, decimal=',', dtype={'item': str, 'state': str})
+        self.foods = dataframe['item'].to_numpy(dtype=str)
+        self.state = dataframe['state'].to_numpy(dtype=str)
+        # All the numeric columns in a single float matrix, missing values become nan
+        self.values = dataframe[NUMERIC_COLUMNS].to_numpy(dtype=np.float64)
+
+    def _fingerprint(self):
+        """ Return the mtime and size of the csv, and a function computing its hash only when needed """
+        stat = os.stat(self.path)
+        def digest():
+            with open(self.path, 'rb') as file:
+                return hashlib.sha256(file.read()).hexdigest()
+        return stat.st_mtime_ns, stat.st_size, digest
+
+    def _load_cache(self):
+        """ Memory map the cached arrays if the csv has not changed, return whether it succeeded """
+        try:
+            with open(os.path.join(self.cache_path, 'meta.json')) as file:
+                meta = json.load(file)
+            mtime, size, digest = self._fingerprint()
+            # A different mtime alone does not invalidate the cache, as long as the content hash is the same
+            if (mtime, size) != (meta['mtime'], meta['size']):
+                if size != meta['size'] or digest() != meta['sha256']:
+                    return False
+                meta['mtime'] = mtime
+                self._write_meta(meta)
+            # Read-only memory maps, so several processes share the same pages
+            for name in CACHE_ARRAYS:
+                setattr(self, name, np.load(os.path.join(self.cache_path, meta['files'][name]), mmap_mode='r'))
+        except (OSError, KeyError, ValueError):
+            return False
+        return True
+
+    def _write_cache(self):
+        """ Save the parsed arrays next to the csv as .npy files """
+        try:
+            os.makedirs(self.cache_path, exist_ok=True)
+            mtime, size, digest = self._fingerprint()
+            sha256 = digest()
+            # The file names carry the hash, so a reader never mixes the arrays of two versions of the csv
+            files = {name: f'{name}-{sha256[:16]}.npy' for name in CACHE_ARRAYS}
+            for name, filename in files.items():
+                temporary = os.path.join(self.cache_path, f'{filename}.{os.getpid()}.tmp')
+                with open(temporary, 'wb') as file:
+                    np.save(file, getattr(self, name))
+                os.replace(temporary, os.path.join(self.cache_path, filename))
+            # The metadata goes last: once it is replaced, readers switch to the new arrays
+            self._write_meta({'mtime': mtime, 'size': size, 'sha256': sha256, 'files': files})
+            # Remove the arrays of older versions, processes still mapping them keep their pages
+            for filename in os.listdir(self.cache_path):
+                if filename.endswith('.npy') and filename not in files.values():
+                    os.remove(os.path.join(self.cache_path, filename))
+        except OSError:
+            # The cache is only an optimization, e.g. the csv may live in a read-only directory
+            pass
+
+    def _write_meta(self, meta):
+        temporary = os.path.join(self.cache_path, f'meta.json.{os.getpid()}.tmp')
+        with open(temporary, 'w') as file:
+            json.dump(meta, file)
+        os.replace(temporary, os.path.join(self.cache_path, 'meta.json'))
+
+    def _set_columns(self):
+        """ Expose each numeric column, and the nutrients block, as views on the matrix """
+        self.columns = {column: self.values[:, i] for i, column in enumerate(NUMERIC_COLUMNS)}
+        start = NUMERIC_COLUMNS.index(NUTRIENTS[0])
+        self.nutrients = self.values[:, start:start + len(NUTRIENTS)]
+
+    def __len__(self):
+        return len(self.foods)
+
+    def __contains__(self, food):
+        return food in self.index
+
+    def __getitem__(self, food):
+        """ Return the nutrients of a single food """
+        return self.nutrients[self.index[food]]
+
+    def rows(self, foods):
+        """ Return the row indexes of the given foods """
+        return np.fromiter((self.index[food] for food in foods), dtype=np.intp, count=len(foods))
+
+    def scale(self, foods, quantities):
+        """ Return the nutrients of the given foods multiplied by their quantities, one row per food """
+        return self.nutrients[self.rows(foods)] * np.asarray(quantities, dtype=np.float64)[:, None]
 
 class Day:
     def __init__(self, ):
@@ -62,16 +259,12 @@ class Day:
     
     def adding_food(self, dictionary_food, nutritional_dataframe, meal_label):
         """Create a function which creates a dictionary for each meal"""
-        # Create an empty dataframe which will contain info for each meal
-        food_data = {}
-        for food, quantity in dictionary_food.items():
-            # Create a list which will return the nutritional value of the food you'd like to eat, multiplied by the quantity of it starting from the nutritional db
-            lista = [round(quantity * float(value), 2) for value in nutritionaltable[food][3:-1]]
-            # Append the quantity and the meal label on the list
-            lista.insert(0, quantity)
-            lista.append(meal_label)
-            # Associate each food with its information
-            food_data[food] = lista
+        foods = list(dictionary_food)
+        quantities = list(dictionary_food.values())
+        # Gather the nutritional values of the foods you'd like to eat, multiplied by their quantity, in one shot
+        values = nutritional_dataframe.scale(foods, quantities).round(2).tolist()
+        # Associate each food with its quantity, its nutritional values and the meal label
+        food_data = {food: [quantity, *row, meal_label] for food, quantity, row in zip(foods, quantities, values)}
         
         if meal_label == 'breakfast':
             self.breakfast = food_data
@@ -84,7 +277,7 @@ class Day:
 
     def summary(self):
         self.day = {**self.breakfast, **self.lunch, **self.dinner}
-        self.day = pd.DataFrame.from_dict(self.day, orient='index', columns=['Quantity', 'Kcal', 'Fat', 'Sat_Fat', 'Carbs', 'Sugars', 'Fibers', 'Proteins', 'Salt', 'Meal'])
+        self.day = pd.DataFrame.from_dict(self.day, orient='index', columns=['Quantity', *LABELS, 'Meal'])
         print(self.day)
         
         print("Today you eat: ")
@@ -93,13 +286,63 @@ class Day:
             
         print("\nFor each meal you eat:")
         print(self.day.groupby('Meal').sum())
-      
-vincenzo = Person("Vincenzo", 1999, "M", 177, 83.5, 1.2)
-nutritionaltable = NutritionalTable('/home/vincenzopi/Scrivania/pythonproject/dataframe.csv').df
-daily_breakfast = {'skyr': 1, 'fette toast': 4, 'schocokreme': 50}.
-
-Monday = Day()
-Monday.adding_food({'pasta': 150, 'olio evo' : 15}, nutritionaltable, 'lunch')
-Monday.adding_food(daily_breakfast, nutritionaltable, 'breakfast')
-Monday.summary()
-Monday.day
+
+class MealPlan:
+    """ Evaluate the meals of many people over many days at once """
+    def __init__(self, records, nutritional_table):
+        # The records are (person, day, meal, food, quantity), either as a dataframe or as an iterable of tuples
+        if isinstance(records, pd.DataFrame):
+            self.records = records[RECORD_COLUMNS]
+        else:
+            self.records = pd.DataFrame(records, columns=RECORD_COLUMNS)
+        self.nutritional_table = nutritional_table
+
+    def evaluate(self):
+        """ Compute the nutrients per meal, per day and per person with a single sparse product """
+        # Find the row of each food in the nutritional table
+        rows = pd.Index(self.nutritional_table.foods).get_indexer(self.records['food'])
+        if (rows < 0).any():
+            missing = self.records['food'][rows < 0].unique().tolist()
+            raise KeyError(f"Foods not in the nutritional table: {missing}")
+
+        # Give each (person, day, meal) an integer code
+        codes, meals = pd.MultiIndex.from_frame(self.records[['person', 'day', 'meal']]).factorize()
+        meals = meals.set_names(['person', 'day', 'meal'])
+
+        # Build the meals x foods quantity matrix, repeated foods in the same meal are summed up
+        quantities = sparse.csr_matrix((self.records['quantity'].to_numpy(dtype=np.float64), (codes, rows)),
+                                       shape=(len(meals), len(self.nutritional_table)))
+
+        # Multiply by the foods x nutrients matrix to get the totals of each meal
+        totals = quantities @ self.nutritional_table.nutrients
+        self.meals = pd.DataFrame(totals, index=meals, columns=LABELS).sort_index()
+
+        # Roll the meals up to days and people
+        self.days = self.meals.groupby(level=['person', 'day']).sum()
+        self.persons = self.days.groupby(level='person').sum()
+        return self.meals
+
+    def compare_tdee(self, people):
+        """ Compare the calories eaten each day by each person with their tdee """
+        if not hasattr(self, 'days'):
+            self.evaluate()
+        # The people are either a PersonTable or a list of Person
+        if isinstance(people, PersonTable):
+            tdee = pd.Series(people.tdee, index=people.names, name='TDEE')
+        else:
+            tdee = pd.Series({person.name: person.tdee for person in people}, name='TDEE')
+        comparison = self.days[['Kcal']].join(tdee, on='person')
+        comparison['Difference'] = comparison['Kcal'] - comparison['TDEE']
+        comparison['Ratio'] = comparison['Kcal'] / comparison['TDEE']
+        return comparison
+
+if __name__ == '__main__':
+    vincenzo = Person("Vincenzo", 1999, "M", 177, 83.5, 1.2)
+    nutritionaltable = NutritionalTable('/home/vincenzopi/Scrivania/pythonproject/dataframe.csv')
+    daily_breakfast = {'skyr': 1, 'fette toast': 4, 'schocokreme': 50}
+
+    Monday = Day()
+    Monday.adding_food({'pasta': 150, 'olio evo' : 15}, nutritionaltable, 'lunch')
+    Monday.adding_food(daily_breakfast, nutritionaltable, 'breakfast')
+    Monday.summary()
+    Monday.day
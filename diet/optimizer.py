@@ -0,0 +1,167 @@
+""" Find the cheapest, or the closest to target, meal plan with linear programming """
+import concurrent.futures
+import inspect
+import os
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.optimize import Bounds, LinearConstraint, milp
+from diet import NUTRIENTS, NutritionalTable, PersonTable
+
+# The objectives the optimizer can minimize
+OBJECTIVES = ['cost', 'target']
+
+class InfeasibleError(ValueError):
+    """ No plan satisfies the bounds """
+
+class DietOptimizer:
+    """ Solve daily or weekly diets over the foods of a NutritionalTable """
+    def __init__(self, nutritional_table):
+        self.nutritional_table = nutritional_table
+        # Price of one unit of food, that is a piece or a gram depending on the food
+        self.unit_price = nutritional_table.columns['price_per_pack'] / nutritional_table.columns['gr/pack']
+        # Foods counted in pieces can only be eaten whole
+        self.pieces = nutritional_table.columns['piece'] == 1
+        # Foods with unknown nutrients can't be part of a plan
+        self.known = ~np.isnan(nutritional_table.nutrients).any(axis=1)
+
+    def solve(self, person, **kwargs):
+        """
+        Return the plan for a person, as a food x day dataframe of quantities, and the value of the objective.
+        See _solve for the arguments.
+        """
+        return self._solve(person.tdee, **kwargs)
+
+    def check_arguments(self, **kwargs):
+        """ Raise on arguments of solve which no person can satisfy: unknown arguments, objective, nutrients or foods """
+        inspect.signature(self._solve).bind(0, **kwargs)
+        objective = kwargs.get('objective', 'cost')
+        if objective not in OBJECTIVES:
+            raise ValueError(f"Unknown objective {objective!r}, choose one of {OBJECTIVES}")
+        if objective == 'cost' and not (self.known & ~np.isnan(self.unit_price)).any():
+            raise ValueError("No food of the table has a price and known nutrients, fill price_per_pack "
+                             "or use objective='target'")
+        nutrients = [nutrient for name in ['nutrient_bounds', 'targets'] for nutrient in (kwargs.get(name) or {})]
+        unknown = sorted(set(nutrients) - set(NUTRIENTS))
+        if unknown:
+            raise ValueError(f"Unknown nutrients {unknown}, choose among {NUTRIENTS}")
+        foods = [food for name in ['food_bounds', 'weekly_bounds'] for food in (kwargs.get(name) or {})]
+        missing = sorted(set(foods) - set(self.nutritional_table.index))
+        if missing:
+            raise KeyError(f"Foods not in the nutritional table: {missing}")
+
+    def _solve(self,
+               tdee,
+               nutrient_bounds=None,
+               food_bounds=None,
+               weekly_bounds=None,
+               objective='cost',
+               targets=None,
+               days=1,
+               whole_pieces=True):
+        """
+        tdee: the daily calories of the person
+        nutrient_bounds: {nutrient: (min, max)} per day, kcal defaults to the tdee +/- 10%
+        food_bounds: {food: (min, max)} quantity per day
+        weekly_bounds: {food: (min, max)} quantity over all the days, to force some variety
+        objective: 'cost' minimizes the price, foods without a price are left out;
+                   'target' minimizes the relative distance from the targets, the absolute one below 1
+        targets: {nutrient: value} per day for the 'target' objective, kcal defaults to the tdee
+        days: number of days of the plan
+        whole_pieces: solve a MILP where the foods counted in pieces are integers
+        """
+        self.check_arguments(nutrient_bounds=nutrient_bounds, food_bounds=food_bounds, weekly_bounds=weekly_bounds,
+                             objective=objective, targets=targets)
+        table = self.nutritional_table
+        foods = len(table)
+        nutrient_bounds = {'kcal': (0.9 * tdee, 1.1 * tdee), **(nutrient_bounds or {})}
+        targets = {'kcal': tdee, **(targets or {})} if objective == 'target' else {}
+
+        # Quantity bounds of each food on each day, the variables are laid out day by day
+        lower = np.zeros(foods)
+        upper = np.where(self.known, np.inf, 0)
+        if objective == 'cost':
+            upper[np.isnan(self.unit_price)] = 0
+        for food, (low, high) in (food_bounds or {}).items():
+            row = table.index[food]
+            lower[row], upper[row] = low, min(high, upper[row])
+        lower, upper = np.tile(lower, days), np.tile(upper, days)
+        integrality = np.tile(self.pieces & whole_pieces, days).astype(int)
+
+        # The nutrients of each day: a block diagonal of the nutrients x foods matrix
+        nutrients = np.nan_to_num(table.nutrients).T
+        bounded = [NUTRIENTS.index(nutrient) for nutrient in nutrient_bounds]
+        daily = sparse.kron(sparse.eye(days), sparse.csr_matrix(nutrients[bounded]), format='csr')
+        constraints = [LinearConstraint(daily,
+                                        np.tile([low for low, _ in nutrient_bounds.values()], days),
+                                        np.tile([high for _, high in nutrient_bounds.values()], days))]
+
+        # The total quantity of some foods over the whole plan
+        if weekly_bounds:
+            rows = table.rows(list(weekly_bounds))
+            weekly = sparse.kron(np.ones((1, days)), sparse.csr_matrix((np.ones(len(rows)), (np.arange(len(rows)), rows)),
+                                                                        shape=(len(rows), foods)), format='csr')
+            constraints.append(LinearConstraint(weekly,
+                                                [low for low, _ in weekly_bounds.values()],
+                                                [high for _, high in weekly_bounds.values()]))
+
+        if objective == 'cost':
+            cost = np.nan_to_num(np.tile(self.unit_price, days))
+        else:
+            # Add two slack variables per day and target, for the shortfall and the excess:
+            # nutrients + shortfall - excess = target, and minimize the slacks relative to the target
+            targeted = [NUTRIENTS.index(nutrient) for nutrient in targets]
+            values = np.array(list(targets.values()), dtype=np.float64)
+            slacks = days * len(targeted)
+            achieved = sparse.kron(sparse.eye(days), sparse.csr_matrix(nutrients[targeted]), format='csr')
+            identity = sparse.eye(slacks, format='csr')
+            constraints = [LinearConstraint(sparse.hstack([constraint.A, sparse.csr_matrix((constraint.A.shape[0], 2 * slacks))]),
+                                            constraint.lb, constraint.ub) for constraint in constraints]
+            target = np.tile(values, days)
+            constraints.append(LinearConstraint(sparse.hstack([achieved, identity, -identity]), target, target))
+            # A target of zero, e.g. no sugar, is weighted per unit instead of relative to the target
+            weights = np.tile(1 / np.maximum(np.abs(values), 1), days)
+            cost = np.concatenate([np.zeros(days * foods), weights, weights])
+            lower = np.concatenate([lower, np.zeros(2 * slacks)])
+            upper = np.concatenate([upper, np.full(2 * slacks, np.inf)])
+            integrality = np.concatenate([integrality, np.zeros(2 * slacks, dtype=int)])
+
+        result = milp(cost, constraints=constraints, integrality=integrality, bounds=Bounds(lower, upper))
+        if result.x is None:
+            raise InfeasibleError(f"No plan found: {result.message}")
+
+        # Keep only the foods which appear in the plan
+        quantities = result.x[:days * foods].reshape(days, foods).T.round(2)
+        eaten = quantities.any(axis=1)
+        plan = pd.DataFrame(quantities[eaten],
+                            index=pd.Index(table.foods[eaten], name='food'),
+                            columns=pd.RangeIndex(1, days + 1, name='day'))
+        return plan, result.fun
+
+    def solve_many(self, people, max_workers=None, **kwargs):
+        """
+        Solve the plans of many people in a process pool, with the same arguments of solve.
+        The people are a PersonTable or a list of Person. Returns a list of (plan, value), None when no plan exists.
+        The arguments are checked once before solving, so a mistake raises instead of giving None for everyone.
+        """
+        self.check_arguments(**kwargs)
+        tdees = people.tdee.tolist() if isinstance(people, PersonTable) else [person.tdee for person in people]
+        # Each worker reloads the table from its cache, instead of receiving it pickled
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers,
+                                                    initializer=_init_worker,
+                                                    initargs=(self.nutritional_table.path,)) as pool:
+            chunksize = max(1, len(tdees) // (4 * (max_workers or os.cpu_count())))
+            return list(pool.map(_solve_one, tdees, [kwargs] * len(tdees), chunksize=chunksize))
+
+# The optimizer of each worker process of solve_many
+_worker_optimizer = None
+
+def _init_worker(path):
+    global _worker_optimizer
+    _worker_optimizer = DietOptimizer(NutritionalTable(path))
+
+def _solve_one(tdee, kwargs):
+    try:
+        return _worker_optimizer._solve(tdee, **kwargs)
+    except InfeasibleError:
+        return None
@@ -1,22 +1,37 @@
 # Inspired by  Algorithmic Trading – Machine Learning & Quant Strategies Course with Python by freeCodeCamp.org
-!pip install pandas-ta
+# !pip install pandas-ta
 
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
-import statsmodels.api as sm
-import pandas_datareader.data as web
 import yfinance as yf
-from statsmodels.regression.rolling import RollingOLS
 import datetime as dt
 import pandas_ta
+from store import OHLCVStore
+import functools
+from indicators import compute_indicators, indicators_kernel, output_columns, required_columns, returns_kernel
+from panel import Panel, compact, monthly_data
+from parallel import run_sharded
+from streaming import IndicatorState, MonthlyState
+from backtest import Backtest
+from factors import download_factors, factor_betas, read_factors
+from profiling import Profiler, profiled, stage
 
 class DataFrame:
-  def __init__(self, end_date):
-    """ Instantiate the strategy by downloading the SP500 companies, and set the time window of your backtest"""
+  def __init__(self, end_date, store: OHLCVStore = None, profiler: Profiler = None):
+    """ Instantiate the strategy by downloading the SP500 companies, and set the time window of your backtest.
+    With a store, the symbols and the prices are read from it and only the missing data is downloaded.
+    With a profiler, each stage of the pipeline and each indicator is recorded by it """
+    self.store = store
+    self.profiler = profiler
     self.stock_link = 'https://en.wikipedia.org/wiki/List_of_S%26P_500_companies'
-    self.stock_symbols = pd.read_html(self.stock_link)[0]['Symbol'].str.replace('.', '-', regex = False).unique().tolist()
+    if self.store is None:
+      self.stock_symbols = pd.read_html(self.stock_link)[0]['Symbol'].str.replace('.', '-', regex = False).unique().tolist()
+    else:
+      self.stock_symbols = self.store.symbols()
     self.end_date = end_date
+    # The monthly adjusted close of every ticker before filtering, for the forward returns of the backtests
+    self.monthly_prices = None
     self.start_date = pd.to_datetime(end_date) - pd.DateOffset(365*8)
 
   def __str__(self):
@@ -35,9 +50,17 @@ class DataFrame:
     dataframe.columns = dataframe.columns.str.lower()
     return dataframe
 
-  def get_dataframe(self):
-    self.dataframe = self._download_dataframe()
-    self.dataframe = self._fixed_dataframe(self.dataframe)
+  @profiled
+  def get_dataframe(self, compact_panel = False):
+    """ Get the prices, with compact_panel they are stored as float32 """
+    if self.store is None:
+      self.dataframe = self._download_dataframe()
+      self.dataframe = self._fixed_dataframe(self.dataframe)
+    else:
+      self.store.update(self.stock_symbols, self.start_date, self.end_date)
+      self.dataframe = self.store.load(self.stock_symbols, self.start_date, self.end_date)
+    if compact_panel:
+      self.dataframe = compact(self.dataframe)
 
   def _garman_klass(self):
     """ Create the Garman-Klass indicator """
@@ -83,8 +106,11 @@ class DataFrame:
     """ Get the liquidity indicator """
     self.dataframe['dollar_volume'] = (self.dataframe['adj close'] * self.dataframe['volume']) / 1e6
 
-  def get_tech_indicators(self, lista: list, liquidity = False):
-    """ Get the techincal indicators, whichever you want """
+  @profiled
+  def get_tech_indicators(self, lista: list, liquidity = False, vectorized = False, parallel = False, max_workers = None):
+    """ Get the techincal indicators, whichever you want.
+    With vectorized, all the indicators are computed at once for all the tickers by the IndicatorEngine,
+    with parallel the tickers are also split across a pool of max_workers processes """
     # Create a key value pair, so that for each indicator's name you have the corresponding functions
     indicators_map = {
         "garman_klass": self._garman_klass,
@@ -96,15 +122,38 @@ class DataFrame:
 
     if liquidity == True:
       # Add the liquidity indicator
-      self._dollar_volume()
+      with stage(self.profiler, 'dollar_volume', self, category = 'indicator'):
+        self._dollar_volume()
+
+    if parallel:
+      panel = Panel(self.dataframe.index)
+      prices = {column: self.dataframe[column].to_numpy(dtype = np.float64) for column in required_columns(lista)}
+      # The indicators run in the worker processes, the profiler records them together
+      with stage(self.profiler, 'sharded indicators', category = 'indicator', shape = (len(self.dataframe), len(output_columns(lista)))):
+        columns = run_sharded(functools.partial(indicators_kernel, lista, 20), panel, prices, output_columns(lista), max_workers)
+    elif vectorized:
+      columns = compute_indicators(self.dataframe, lista, profiler = self.profiler)
+    if parallel or vectorized:
+      # The indicators take the dtype of the prices, float32 for a compact panel
+      for column, values in columns.items():
+        self.dataframe[column] = values.astype(self.dataframe['close'].dtype)
+      return
 
     # Run each indicator in the list
     for indicator in lista:
         if indicator in indicators_map:
-            indicators_map[indicator]()
+            with stage(self.profiler, indicator, self, category = 'indicator'):
+              indicators_map[indicator]()
 
-  def get_monthly_data(self):
-    """ Get the average monthly liquidity and monthly indicators, taking the last value per month """
+  @profiled
+  def get_monthly_data(self, compact_panel = False):
+    """ Get the average monthly liquidity and monthly indicators, taking the last value per month.
+    With compact_panel the daily rows are grouped by month and ticker, without unstacking the whole dataframe """
+
+    if compact_panel:
+      self.dataframe = monthly_data(self.dataframe)
+      self.monthly_prices = self.dataframe['adj close'].unstack('ticker')
+      return
 
     # Define the columns you want to keep, which are the indicators
     last_cols = [c for c in self.dataframe.columns.unique(0) if c not in ['dollar_volume', 'volume', 'open', 'high', 'low', 'close']]
@@ -116,7 +165,31 @@ class DataFrame:
 
     # Concatenate the calculated values
     self.dataframe = pd.concat([avg_dollar_volume, last_values], axis=1).dropna()
-
+    self.monthly_prices = self.dataframe['adj close'].unstack('ticker')
+
+  @profiled
+  def get_monthly_chunked(self, lista: list, chunk_size = 100, compact_panel = True):
+    """ Load the prices, get the indicators and the monthly data by groups of chunk_size tickers, so that only
+    the daily data of one group is in memory at a time. Needs a store to load the tickers by groups """
+    if self.store is None:
+      raise ValueError("Loading the tickers by groups needs a store")
+    monthly = []
+    for start in range(0, len(self.stock_symbols), chunk_size):
+      tickers = self.stock_symbols[start:start + chunk_size]
+      self.store.update(tickers, self.start_date, self.end_date)
+      try:
+        self.dataframe = self.store.load(tickers, self.start_date, self.end_date)
+      except KeyError:
+        # None of the tickers of the group has data
+        continue
+      if compact_panel:
+        self.dataframe = compact(self.dataframe)
+      self.get_tech_indicators(lista, liquidity = True, vectorized = True)
+      monthly.append(monthly_data(self.dataframe))
+    self.dataframe = pd.concat(monthly).sort_index()
+    self.monthly_prices = self.dataframe['adj close'].unstack('ticker')
+
+  @profiled
   def filtering(self):
     """ Calculate the 5-year rolling average of dollar volume for each stock and filter in the first 150 most liquid companies """
 
@@ -129,8 +202,36 @@ class DataFrame:
     # Filter the first 150 most liquid companies
     self.dataframe = self.dataframe[self.dataframe['dollar_volume_5_rank'] < 150].drop(['dollar_volume', 'dollar_volume_5', 'dollar_volume_5_rank'], axis=1)
 
-  def returns(self, lags_in_month: list = [1, 2, 3, 6, 9, 12], outlier_cutoff = 0):
-    """ Calculate monthly returns considering different lags"""
+  def start_streaming(self, lista: list, periods = 20):
+    """ Build the rolling state of the indicators and of the monthly data from the daily dataframe
+    after get_tech_indicators (with liquidity), so that add_bars can update them day by day """
+    self.indicator_state = IndicatorState.from_dataframe(self.dataframe, lista, periods)
+    self.monthly_state = MonthlyState.from_dataframe(self.dataframe)
+
+  def add_bars(self, date, bars):
+    """ Update the features with the bars of a new day, a dataframe of prices indexed by ticker, in O(tickers)
+    instead of recomputing the whole history. Return the new daily rows, and the closed month with
+    dollar_volume_5 and its rank when the date starts a new month, None otherwise """
+    rows = self.indicator_state.update(bars)
+    return rows, self.monthly_state.update(date, rows)
+
+  @profiled
+  def returns(self, lags_in_month: list = [1, 2, 3, 6, 9, 12], outlier_cutoff = 0, vectorized = False, parallel = False, max_workers = None):
+    """ Calculate monthly returns considering different lags.
+    With vectorized, or parallel across a pool of max_workers processes, the returns of all the tickers are computed at once """
+
+    if parallel or vectorized:
+      panel = Panel(self.dataframe.index)
+      kernel = functools.partial(returns_kernel, lags_in_month, outlier_cutoff)
+      prices = {'adj close': self.dataframe['adj close'].to_numpy(dtype = np.float64)}
+      if parallel:
+        columns = run_sharded(kernel, panel, prices, [f'return_{lag}m' for lag in lags_in_month], max_workers)
+      else:
+        columns = {column: panel.unpack(values) for column, values in kernel({'adj close': panel.pack(prices['adj close'])}, panel.valid).items()}
+      for column, values in columns.items():
+        self.dataframe[column] = values
+      self.dataframe = self.dataframe.dropna()
+      return
 
     def _calculate_returns(data):
 
@@ -148,9 +249,27 @@ class DataFrame:
 
     self.dataframe = self.dataframe.groupby(level=1, group_keys=False).apply(_calculate_returns).dropna()
 
-strategy = DataFrame('2023-09-27')
-strategy.get_dataframe()
-strategy.get_tech_indicators(["rsi", "macd"], liquidity = True)
-strategy.get_monthly_data()
-strategy.filtering()
-strategy.returns(outlier_cutoff = 0.005)
+  @profiled
+  def factor_betas(self, factors_path, window = 24, min_months = 10):
+    """ Add the rolling betas of each ticker on the Fama-French factors, read from a local csv (see factors.download_factors),
+    after returns. The betas of a month are estimated up to the previous month, and the missing ones take the ticker average """
+    factors = read_factors(factors_path)
+    betas = factor_betas(self.dataframe, factors, window, min_months).groupby(level = 'ticker').shift()
+    self.dataframe = self.dataframe.join(betas)
+    self.dataframe[factors.columns] = self.dataframe.groupby(level = 'ticker')[factors.columns].transform(lambda x: x.fillna(x.mean()))
+    self.dataframe = self.dataframe.dropna()
+
+  def backtest(self):
+    """ Return a Backtest of the monthly frame, to evaluate portfolios built on its features after returns.
+    The forward returns come from the monthly prices of all the tickers, before filtering """
+    return Backtest(self.dataframe, self.monthly_prices)
+
+if __name__ == '__main__':
+  strategy = DataFrame('2023-09-27')
+  strategy.get_dataframe()
+  strategy.get_tech_indicators(["rsi", "macd"], liquidity = True)
+  strategy.get_monthly_data()
+  strategy.filtering()
+  strategy.returns(outlier_cutoff = 0.005)
+  download_factors('factors.csv')
+  strategy.factor_betas('factors.csv')
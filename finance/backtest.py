@@ -0,0 +1,102 @@
+""" Vectorized backtests of monthly portfolios built on the monthly frame of the algotrading pipeline """
+import concurrent.futures
+import numpy as np
+import pandas as pd
+
+def rank_weights(feature, tops: list, ascending = False):
+  """
+  Return equal weights on the top tickers of each date by the feature, a dates x tickers array,
+  for each number of tickers in tops: an array of shape (len(tops), dates, tickers)
+  """
+  ranks = pd.DataFrame(feature).rank(axis = 1, ascending = ascending, method = 'first').to_numpy()
+  selected = ranks[None, :, :] <= np.asarray(tops)[:, None, None]
+  with np.errstate(invalid = 'ignore', divide = 'ignore'):
+    weights = selected / selected.sum(axis = -1, keepdims = True)
+  return np.nan_to_num(weights)
+
+def run(weights, returns, costs = (0.001,)):
+  """
+  Backtest weights of shape (..., dates, tickers), held from each date to the next one, against the
+  dates x tickers forward returns, for each cost per unit of turnover. Every result has shape (costs, ..., dates)
+  """
+  # The portfolio return of each date, summed over the tickers
+  gross = np.einsum('...tn,tn->...t', weights, returns)
+
+  # Before rebalancing, the weights of the previous date have drifted with its returns
+  drifted = np.zeros_like(weights)
+  with np.errstate(invalid = 'ignore', divide = 'ignore'):
+    drifted[..., 1:, :] = weights[..., :-1, :] * (1 + returns[:-1]) / (1 + gross[..., :-1, None])
+  turnover = np.abs(weights - np.nan_to_num(drifted)).sum(axis = -1)
+
+  costs = np.asarray(costs).reshape((-1,) + (1,) * turnover.ndim)
+  net = gross - costs * turnover
+  equity = np.cumprod(1 + net, axis = -1)
+  drawdown = equity / np.maximum.accumulate(equity, axis = -1) - 1
+  return {'gross': np.broadcast_to(gross, net.shape),
+          'turnover': np.broadcast_to(turnover, net.shape),
+          'net': net,
+          'equity': equity,
+          'drawdown': drawdown}
+
+def summary(results, periods_per_year = 12):
+  """ Reduce the results of run over the dates: returns, volatility, sharpe, drawdown and turnover """
+  net = results['net']
+  years = net.shape[-1] / periods_per_year
+  volatility = net.std(axis = -1, ddof = 1) * np.sqrt(periods_per_year)
+  with np.errstate(invalid = 'ignore', divide = 'ignore'):
+    return {'total_return': results['equity'][..., -1] - 1,
+            'annual_return': results['equity'][..., -1] ** (1 / years) - 1,
+            'volatility': volatility,
+            'sharpe': net.mean(axis = -1) * periods_per_year / volatility,
+            'max_drawdown': results['drawdown'].min(axis = -1),
+            'turnover': results['turnover'].mean(axis = -1)}
+
+def _sweep_feature(feature, returns, tops, costs, ascending):
+  """ Summary of all the tops and costs of a feature, as {statistic: array of shape (costs, tops)} """
+  return summary(run(rank_weights(feature, tops, ascending), returns, costs))
+
+class Backtest:
+  """ Backtest monthly portfolios over the tickers of the monthly frame produced by DataFrame.returns """
+  def __init__(self, dataframe, prices = None):
+    """ prices are the dates x tickers monthly prices before filtering, see DataFrame.monthly_prices. The forward
+    returns come from them, so that a ticker which leaves the frame the next month still earns its return.
+    Without them the prices of the frame are used """
+    self.dataframe = dataframe
+    features = dataframe['adj close'].unstack('ticker')
+    close = features if prices is None else prices.reindex(columns = features.columns)
+    # The return from each month to the next month with a price, computed before selecting the dates of the frame
+    forward = close.shift(-1) / close - 1
+    # The last month has no next month to be held until
+    dates = features.index[features.index < close.index[-1]]
+    self.dates = dates
+    self.tickers = features.columns
+    # Zero where the ticker has no price in one of the two months, e.g. it was delisted
+    self.returns = np.nan_to_num(forward.reindex(dates).to_numpy())
+
+  def feature(self, column):
+    """ Return a feature as a dates x tickers array """
+    return self.dataframe[column].unstack('ticker').reindex(index = self.dates, columns = self.tickers).to_numpy()
+
+  def run(self, weights, costs = (0.001,)):
+    """ Backtest a dates x tickers dataframe of weights, e.g. from a clustering, returning a dataframe per cost """
+    weights = weights.reindex(index = self.dates, columns = self.tickers).fillna(0).to_numpy()
+    results = run(weights, self.returns, costs)
+    return {cost: pd.DataFrame({name: values[i] for name, values in results.items()}, index = self.dates)
+            for i, cost in enumerate(costs)}
+
+  def sweep(self, columns: list, tops: list, costs: list, ascending = False, max_workers = None):
+    """
+    Backtest the equal weighted top tickers by each feature, for every combination of feature, number of tickers
+    and cost. The combinations of a feature are computed at once, and the features in a process pool.
+    Return a dataframe of statistics indexed by (feature, top, cost)
+    """
+    with concurrent.futures.ProcessPoolExecutor(max_workers = max_workers) as pool:
+      futures = {column: pool.submit(_sweep_feature, self.feature(column), self.returns, tops, costs, ascending)
+                 for column in columns}
+      results = {column: future.result() for column, future in futures.items()}
+
+    frames = []
+    for column, statistics in results.items():
+      index = pd.MultiIndex.from_product([[column], costs, tops], names = ['feature', 'cost', 'top'])
+      frames.append(pd.DataFrame({name: values.ravel() for name, values in statistics.items()}, index = index))
+    return pd.concat(frames).reorder_levels(['feature', 'top', 'cost']).sort_index()
@@ -0,0 +1,200 @@
+""" Benchmark the algotrading pipeline offline on synthetic data, run it as `python benchmark.py` """
+import os
+import platform
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+import statsmodels.api as sm
+from statsmodels.regression.rolling import RollingOLS
+from algotrading import DataFrame
+from factors import FACTORS, factor_betas, read_factors
+from profiling import Profiler
+from store import OHLCVStore, SyntheticSource
+
+END_DATE = '2023-09-27'
+INDICATORS = ["garman_klass", "rsi", "bollinger_bands", "atr", "macd"]
+
+def synthetic_strategy(n_tickers = 500, end_date = END_DATE):
+  """ Return a DataFrame whose prices, about 2000 days per ticker, come from a SyntheticSource """
+  with tempfile.TemporaryDirectory() as directory:
+    strategy = DataFrame(end_date, store = OHLCVStore(directory, SyntheticSource(n_tickers)))
+    strategy.get_dataframe()
+  return strategy
+
+def synthetic_factors(path, start, end = END_DATE, seed = 0):
+  """ Write random monthly factors, in percent, to a csv in the format of Kenneth French's website """
+  months = pd.period_range(start, end, freq = 'M')
+  rng = np.random.default_rng(seed)
+  factors = pd.DataFrame(rng.normal(0.5, 4, (len(months), len(FACTORS))).round(2), columns = FACTORS,
+                         index = pd.Index(months.strftime('%Y%m'), name = 'date'))
+  factors.to_csv(path)
+
+def bench_indicators(n_tickers = 500):
+  strategy = synthetic_strategy(n_tickers)
+  prices = strategy.dataframe
+  results = {}
+  for vectorized in [False, True]:
+    strategy.dataframe = prices.copy()
+    start = time.perf_counter()
+    strategy.get_tech_indicators(INDICATORS, liquidity = True, vectorized = vectorized)
+    results[vectorized] = (time.perf_counter() - start, strategy.dataframe)
+
+  (groupby_time, expected), (engine_time, actual) = results[False], results[True]
+  print(f"{n_tickers} tickers x {prices.index.get_level_values('date').nunique()} days")
+  print(f"groupby-apply: {groupby_time:.2f} s")
+  print(f"engine:        {engine_time:.2f} s ({groupby_time / engine_time:.1f}x)")
+  for column in expected.columns.difference(prices.columns):
+    difference = np.nanmax(np.abs(expected[column].to_numpy() - actual[column].to_numpy()))
+    print(f"  {column}: max abs difference {difference:.2e}")
+
+def bench_parallel(n_tickers = 2000):
+  strategy = synthetic_strategy(n_tickers)
+  prices = strategy.dataframe
+  vectorized_time = None
+  print(f"{n_tickers} tickers, {len(prices):,} rows")
+  for max_workers in [None] + [2**i for i in range(os.cpu_count().bit_length())]:
+    strategy.dataframe = prices.copy()
+    start = time.perf_counter()
+    strategy.get_tech_indicators(INDICATORS, vectorized = True, parallel = max_workers is not None, max_workers = max_workers)
+    elapsed = time.perf_counter() - start
+    if max_workers is None:
+      vectorized_time = elapsed
+      print(f"vectorized:  {elapsed:.2f} s")
+    else:
+      print(f"{max_workers:2d} workers:  {elapsed:.2f} s ({vectorized_time / elapsed:.1f}x)")
+
+def bench_streaming(n_tickers = 500, new_days = 20):
+  strategy = synthetic_strategy(n_tickers)
+  prices = strategy.dataframe
+  dates = prices.index.get_level_values('date').unique()
+  history = prices.index.get_level_values('date') < dates[-new_days]
+
+  # Recomputing everything for each new day
+  strategy.dataframe = prices.copy()
+  start = time.perf_counter()
+  strategy.get_tech_indicators(INDICATORS, liquidity = True, vectorized = True)
+  full_time = time.perf_counter() - start
+
+  # Updating the state with each new day
+  strategy.dataframe = prices[history].copy()
+  strategy.get_tech_indicators(INDICATORS, liquidity = True, vectorized = True)
+  strategy.start_streaming(INDICATORS)
+  start = time.perf_counter()
+  for date in dates[-new_days:]:
+    strategy.add_bars(date, prices.xs(date, level = 'date'))
+  update_time = (time.perf_counter() - start) / new_days
+
+  print(f"{n_tickers} tickers, one new day")
+  print(f"full recompute:    {full_time * 1000:.1f} ms")
+  print(f"streaming update:  {update_time * 1000:.1f} ms ({full_time / update_time:.0f}x)")
+
+def bench_memory(n_tickers = 500, chunk_size = 100):
+  """ Peak memory, traced by tracemalloc, from loading the prices to the monthly frame """
+  def default(strategy):
+    strategy.get_dataframe()
+    strategy.get_tech_indicators(INDICATORS, liquidity = True, vectorized = True)
+    strategy.get_monthly_data()
+
+  def compact(strategy):
+    strategy.get_dataframe(compact_panel = True)
+    strategy.get_tech_indicators(INDICATORS, liquidity = True, vectorized = True)
+    strategy.get_monthly_data(compact_panel = True)
+
+  def chunked(strategy):
+    strategy.get_monthly_chunked(INDICATORS, chunk_size = chunk_size)
+
+  with tempfile.TemporaryDirectory() as directory:
+    strategy = DataFrame(END_DATE, store = OHLCVStore(directory, SyntheticSource(n_tickers)))
+    # Fill the store first, so that every run reads the same files
+    strategy.get_dataframe()
+    print(f"{n_tickers} tickers, {len(strategy.dataframe):,} daily rows")
+    results = {}
+    for label, pipeline in [('default', default), ('compact', compact), (f'chunked by {chunk_size}', chunked)]:
+      strategy.dataframe = None
+      tracemalloc.start()
+      start = time.perf_counter()
+      pipeline(strategy)
+      elapsed = time.perf_counter() - start
+      peak = tracemalloc.get_traced_memory()[1]
+      tracemalloc.stop()
+      results[label] = strategy.dataframe
+      print(f"{label:14s} peak {peak / 2**20:7.1f} MiB, {elapsed:.2f} s")
+
+  expected = results['default']
+  for label, monthly in results.items():
+    # float32 keeps about 7 significant digits
+    difference = np.nanmax(np.abs(monthly.to_numpy(dtype = np.float64) - expected.to_numpy()))
+    print(f"{label:14s} {monthly.shape}, max absolute difference {difference:.1e}")
+
+def bench_factors(n_tickers = 500, window = 12):
+  """ Batched rolling betas against one RollingOLS per ticker, on random factors """
+  strategy = synthetic_strategy(n_tickers)
+  strategy.get_tech_indicators(INDICATORS, liquidity = True, vectorized = True)
+  strategy.get_monthly_data()
+  strategy.filtering()
+  strategy.returns(vectorized = True)
+
+  with tempfile.TemporaryDirectory() as directory:
+    path = os.path.join(directory, 'factors.csv')
+    synthetic_factors(path, strategy.start_date)
+    factors = read_factors(path)
+
+  start = time.perf_counter()
+  betas = factor_betas(strategy.dataframe, factors, window)
+  batched_time = time.perf_counter() - start
+
+  data = strategy.dataframe[['return_1m']].join(factors).loc[betas.index]
+  start = time.perf_counter()
+  expected = data.groupby(level = 'ticker', group_keys = False).apply(
+      lambda x: RollingOLS(endog = x['return_1m'], exog = sm.add_constant(x[FACTORS]), window = min(window, len(x)),
+                           min_nobs = len(FACTORS) + 1).fit(params_only = True).params.drop('const', axis = 1))
+  rolling_time = time.perf_counter() - start
+
+  difference = np.nanmax(np.abs(betas.to_numpy() - expected.reindex(betas.index).to_numpy()))
+  print(f"{betas.index.get_level_values('ticker').nunique()} tickers, {len(betas):,} months")
+  print(f"RollingOLS per ticker: {rolling_time:.2f} s")
+  print(f"batched:               {batched_time:.3f} s ({rolling_time / batched_time:.0f}x), max abs difference {difference:.1e}")
+
+def bench_pipeline(n_tickers = 500, vectorized = True, capture = False, output = None):
+  """
+  Run the whole pipeline with a Profiler and print its stages. The prices and the factors are synthetic with
+  fixed seeds, so two runs do the same work. With output, write profile.json and trace.json (for chrome://tracing)
+  to that directory, and the cProfile stats of each stage too with capture
+  """
+  profiler = Profiler(capture, metadata = {'n_tickers': n_tickers,
+                                           'end_date': END_DATE,
+                                           'vectorized': vectorized,
+                                           'python': platform.python_version(),
+                                           'numpy': np.__version__,
+                                           'pandas': pd.__version__,
+                                           'machine': platform.machine(),
+                                           'cpus': os.cpu_count()})
+  with tempfile.TemporaryDirectory() as directory:
+    strategy = DataFrame(END_DATE, store = OHLCVStore(directory, SyntheticSource(n_tickers)), profiler = profiler)
+    factors_path = os.path.join(directory, 'factors.csv')
+    synthetic_factors(factors_path, strategy.start_date)
+    strategy.get_dataframe()
+    strategy.get_tech_indicators(INDICATORS, liquidity = True, vectorized = vectorized)
+    strategy.get_monthly_data()
+    strategy.filtering()
+    strategy.returns(outlier_cutoff = 0.005, vectorized = vectorized)
+    strategy.factor_betas(factors_path, window = 12)
+
+  print(profiler)
+  if output is not None:
+    os.makedirs(output, exist_ok = True)
+    profiler.to_json(os.path.join(output, 'profile.json'))
+    profiler.to_chrome_trace(os.path.join(output, 'trace.json'))
+    if capture:
+      profiler.dump_stats(os.path.join(output, 'stats'))
+  return profiler
+
+if __name__ == '__main__':
+  bench_indicators()
+  bench_parallel()
+  bench_streaming()
+  bench_memory()
+  bench_factors()
+  bench_pipeline()
@@ -0,0 +1,80 @@
+""" Rolling factor betas of all the tickers of the monthly frame at once, instead of one RollingOLS per ticker """
+import numpy as np
+import pandas as pd
+from panel import Panel
+
+# The five factors of Fama and French, without the risk free rate
+FACTORS = ['Mkt-RF', 'SMB', 'HML', 'RMW', 'CMA']
+
+def download_factors(path, start = '2010'):
+  """ Save the monthly Fama-French 5 factors to a local csv, for read_factors """
+  import pandas_datareader.data as web
+  factors = web.DataReader('F-F_Research_Data_5_Factors_2x3', 'famafrench', start = start)[0]
+  factors.index = factors.index.to_timestamp()
+  factors.index.name = 'date'
+  factors.to_csv(path)
+
+def read_factors(path, columns: list = FACTORS):
+  """
+  Read the monthly factors from a local csv with a date column, as written by download_factors, and return
+  them as fractions indexed by the end of each month, the dates of DataFrame.get_monthly_data
+  """
+  factors = pd.read_csv(path, index_col = 0)
+  # The csv of Kenneth French's website has dates like 201001
+  index = factors.index.astype(str)
+  dates = pd.to_datetime(index, format = '%Y%m') if index.str.fullmatch(r'\d{6}').all() else pd.to_datetime(index)
+  factors.index = dates.to_period('M').to_timestamp(how = 'end').normalize().rename('date')
+  return factors[columns].astype(np.float64) / 100
+
+def rolling_betas(y, x, windows, valid):
+  """
+  Regress y on a constant and the k columns of x over the last windows rows of each column, for all the
+  columns at once. y has shape (rows, tickers), x (rows, tickers, k) and windows one value per ticker.
+  The sums of the normal equations are cumulative sums, so each window costs one subtraction.
+  Return the slopes, of shape (rows, tickers, k), nan until a ticker has a full window, like RollingOLS
+  """
+  rows, tickers, k = x.shape
+  z = np.concatenate([np.ones((rows, tickers, 1)), x], axis = -1)
+  z = np.where(valid[:, :, None], z, 0)
+  y = np.where(valid, y, 0)
+
+  # Cumulative sums of z'z and z'y, with a row of zeros on top so that the window [t - w, t) is a difference
+  zz = np.zeros((rows + 1, tickers, k + 1, k + 1))
+  zy = np.zeros((rows + 1, tickers, k + 1))
+  np.cumsum(z[:, :, :, None] * z[:, :, None, :], axis = 0, out = zz[1:])
+  np.cumsum(z * y[:, :, None], axis = 0, out = zy[1:])
+
+  end = np.arange(1, rows + 1)[:, None]
+  start = np.maximum(end - np.asarray(windows)[None, :], 0)
+  columns = np.arange(tickers)[None, :]
+  full = (end >= np.asarray(windows)[None, :]) & valid
+
+  # Solve only the full windows
+  a = zz[end, columns][full] - zz[start, columns][full]
+  b = zy[end, columns][full] - zy[start, columns][full]
+  try:
+    params = np.linalg.solve(a, b[..., None])[..., 0]
+  except np.linalg.LinAlgError:
+    # Some window is singular, e.g. a constant factor, fall back to the pseudo inverse like statsmodels
+    params = (np.linalg.pinv(a) @ b[..., None])[..., 0]
+
+  betas = np.full((rows, tickers, k), np.nan)
+  betas[full] = params[:, 1:]
+  return betas
+
+def factor_betas(dataframe, factors, window = 24, min_months = 10):
+  """
+  Return the rolling betas of the return_1m of each ticker of a (date, ticker) monthly frame on the factors,
+  over the last window months of the ticker, or all of them when it has fewer. Only the tickers with at least
+  min_months months of both returns and factors are regressed. The result is indexed like those rows
+  """
+  data = dataframe[['return_1m']].join(factors, how = 'inner').sort_index()
+  months = data.groupby(level = 'ticker').size()
+  data = data[data.index.get_level_values('ticker').isin(months[months >= min_months].index)]
+
+  # Each ticker's months, packed in order at the top of its column, are the rows its RollingOLS would see
+  panel = Panel(data.index)
+  y = panel.pack(data['return_1m'].to_numpy(dtype = np.float64))
+  x = np.stack([panel.pack(data[column].to_numpy(dtype = np.float64)) for column in factors.columns], axis = -1)
+  betas = rolling_betas(y, x, np.minimum(window, panel.counts), panel.valid)
+  return pd.DataFrame({column: panel.unpack(betas[:, :, i]) for i, column in enumerate(factors.columns)}, index = data.index)
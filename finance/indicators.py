@@ -0,0 +1,184 @@
+""" Vectorized technical indicators, computed for all the tickers at once on a Panel """
+import sys
+import numpy as np
+import pandas as pd
+from scipy.signal import lfilter
+from panel import Panel
+from profiling import stage
+
+# The kernels below work on 2D arrays with one column per ticker, as laid out by Panel, and reproduce
+# the pandas_ta functions used by DataFrame (without TA-Lib) along the rows of each column.
+
+def shift(array, periods = 1):
+  """ Shift the rows down, filling the top with nan """
+  shifted = np.full_like(array, np.nan)
+  shifted[periods:] = array[:-periods]
+  return shifted
+
+def ewm_mean(array, alpha, min_periods = 0):
+  """ Same as Series.ewm(alpha = alpha, min_periods = min_periods).mean(), with adjust = True """
+  valid = ~np.isnan(array)
+  # Both the weighted sum and the sum of the weights follow y[t] = x[t] + (1 - alpha) * y[t - 1]
+  decay = [1, -(1 - alpha)]
+  numerator = lfilter([1], decay, np.where(valid, array, 0), axis = 0)
+  denominator = lfilter([1], decay, valid.astype(np.float64), axis = 0)
+  with np.errstate(invalid = 'ignore'):
+    mean = numerator / denominator
+  mean[np.cumsum(valid, axis = 0) < max(min_periods, 1)] = np.nan
+  return mean
+
+def rma(array, length):
+  """ pandas_ta.rma, Wilder's moving average """
+  return ewm_mean(array, 1 / length, min_periods = length)
+
+def ema(array, length):
+  """ pandas_ta.ema: seeded with the simple average of the first values, then ewm with adjust = False """
+  alpha = 2 / (length + 1)
+  result = np.full_like(array, np.nan)
+  if len(array) < length:
+    return result
+  seed = array[:length].mean(axis = 0)
+  result[length - 1] = seed
+  result[length:], _ = lfilter([alpha], [1, -(1 - alpha)], array[length:], axis = 0, zi = ((1 - alpha) * seed)[None, :])
+  return result
+
+def rsi(close, length = 14):
+  """ pandas_ta.rsi """
+  change = close - shift(close)
+  positive = np.where(change < 0, 0, change)
+  negative = np.where(change > 0, 0, change)
+  positive_avg = rma(positive, length)
+  negative_avg = rma(negative, length)
+  return 100 * positive_avg / (positive_avg + np.abs(negative_avg))
+
+def bbands(close, length = 5, std = 2.0, ddof = 0):
+  """ pandas_ta.bbands, returning the lower, mid and upper bands from a single rolling pass """
+  rolling = pd.DataFrame(close).rolling(length)
+  mid = rolling.mean().to_numpy()
+  deviations = std * rolling.std(ddof = ddof).to_numpy()
+  return mid - deviations, mid, mid + deviations
+
+def true_range(high, low, close):
+  """ pandas_ta.true_range """
+  high_low = high - low
+  # pandas_ta adds epsilon to the whole range of a ticker as soon as one of its values is zero
+  high_low = high_low + np.where((high_low == 0).any(axis = 0), sys.float_info.epsilon, 0)
+  previous_close = shift(close)
+  ranges = np.fmax(np.fmax(np.abs(high_low), np.abs(high - previous_close)), np.abs(previous_close - low))
+  ranges[:1] = np.nan
+  return ranges
+
+def atr(high, low, close, length = 14):
+  """ pandas_ta.atr with the default rma """
+  return rma(true_range(high, low, close), length)
+
+def macd(close, fast = 12, slow = 26):
+  """ The MACD line of pandas_ta.macd """
+  return ema(close, fast) - ema(close, slow)
+
+def standardize(array):
+  """ Subtract the mean and divide by the standard deviation of each column, as Series.sub(mean).div(std) """
+  return (array - np.nanmean(array, axis = 0)) / np.nanstd(array, axis = 0, ddof = 1)
+
+def garman_klass(high, low, close, opening):
+  """ The Garman-Klass volatility of DataFrame._garman_klass """
+  return ((np.log(high) - np.log(low))**2) / 2 - (2 * np.log(2) - 1) * (np.log(close) - np.log(opening))**2
+
+def lagged_returns(close, lag, outlier_cutoff = 0):
+  """ The monthly return over the lag of DataFrame.returns, clipped at the quantiles of each column """
+  with np.errstate(invalid = 'ignore'):
+    change = close / shift(close, lag) - 1
+    lower = np.nanquantile(change, outlier_cutoff, axis = 0)
+    upper = np.nanquantile(change, 1 - outlier_cutoff, axis = 0)
+  return (np.clip(change, lower, upper) + 1) ** (1 / lag) - 1
+
+# The price columns needed by each indicator, and the columns it creates
+REQUIREMENTS = {
+    "garman_klass": ['high', 'low', 'adj close', 'open'],
+    "rsi": ['adj close'],
+    "bollinger_bands": ['adj close'],
+    "atr": ['high', 'low', 'close'],
+    "macd": ['close'],
+}
+OUTPUTS = {
+    "garman_klass": ['garman_klass'],
+    "rsi": ['rsi'],
+    "bollinger_bands": ['bb_low', 'bb_mid', 'bb_high'],
+    "atr": ['atr'],
+    "macd": ['macd'],
+}
+
+def required_columns(lista: list):
+  """ Return the price columns needed by the indicators in the list """
+  return list(dict.fromkeys(column for indicator in lista if indicator in REQUIREMENTS for column in REQUIREMENTS[indicator]))
+
+def output_columns(lista: list):
+  """ Return the columns created by the indicators in the list """
+  return [column for indicator in lista if indicator in OUTPUTS for column in OUTPUTS[indicator]]
+
+class IndicatorEngine:
+  """
+  Compute the indicators of DataFrame.get_tech_indicators for many tickers at once, from the price columns
+  laid out as Panel arrays. Each price array is shared by all the indicators which need it
+  """
+  def __init__(self, prices: dict, valid):
+    self.prices = prices
+    # Which cells of the arrays hold a row of the dataframe
+    self.valid = valid
+
+  def mask(self, array):
+    # The moving averages carry their last value below the history, which must not enter the mean and std
+    return np.where(self.valid, array, np.nan)
+
+  def garman_klass(self, periods = 20):
+    prices = self.prices
+    return {'garman_klass': garman_klass(prices['high'], prices['low'], prices['adj close'], prices['open'])}
+
+  def rsi(self, periods = 20):
+    return {'rsi': rsi(self.prices['adj close'], periods)}
+
+  def bollinger_bands(self, periods = 20):
+    low, mid, high = bbands(np.log1p(self.prices['adj close']), periods)
+    return {'bb_low': low, 'bb_mid': mid, 'bb_high': high}
+
+  def atr(self, periods = 20):
+    return {'atr': standardize(self.mask(atr(self.prices['high'], self.prices['low'], self.prices['close'], periods)))}
+
+  def macd(self, periods = 20):
+    # Like the pandas_ta call of DataFrame._macd, the periods are not used and the MACD is 12/26
+    return {'macd': standardize(self.mask(macd(self.prices['close'])))}
+
+  def compute(self, lista: list, periods = 20, profiler = None):
+    """ Return {column: array} for the indicators in the list, each one recorded as a stage of the profiler
+    with the rows of the dataframe and the columns it adds """
+    indicators_map = {
+        "garman_klass": self.garman_klass,
+        "rsi": self.rsi,
+        "bollinger_bands": self.bollinger_bands,
+        "atr": self.atr,
+        "macd": self.macd,
+    }
+    columns = {}
+    rows = int(self.valid.sum())
+    for indicator in lista:
+      if indicator in indicators_map:
+        with stage(profiler, indicator, category = 'indicator', shape = (rows, len(output_columns([indicator])))):
+          columns.update(indicators_map[indicator](periods))
+    return columns
+
+def indicators_kernel(lista, periods, prices, valid):
+  """ Compute the indicators on panel arrays, see parallel.run_sharded """
+  return IndicatorEngine(prices, valid).compute(lista, periods)
+
+def returns_kernel(lags_in_month, outlier_cutoff, prices, valid):
+  """ Compute the lagged returns on panel arrays, see parallel.run_sharded """
+  return {f'return_{lag}m': lagged_returns(prices['adj close'], lag, outlier_cutoff) for lag in lags_in_month}
+
+def compute_indicators(dataframe, lista: list, periods = 20, profiler = None):
+  """ Return {column: values in the order of the rows} with the indicators of a (date, ticker) dataframe """
+  with stage(profiler, 'pack', category = 'indicator'):
+    panel = Panel(dataframe.index)
+    prices = {column: panel.pack(dataframe[column].to_numpy(dtype = np.float64)) for column in required_columns(lista)}
+  columns = IndicatorEngine(prices, panel.valid).compute(lista, periods, profiler)
+  with stage(profiler, 'unpack', category = 'indicator'):
+    return {column: panel.unpack(values) for column, values in columns.items()}
@@ -0,0 +1,54 @@
+""" Array layout of the (date, ticker) dataframes of the algotrading pipeline """
+import numpy as np
+import pandas as pd
+
+class Panel:
+  """
+  Map the rows of a (date, ticker) dataframe to a 2D array with one column per ticker, where the rows of each
+  ticker are packed at the top in date order. When all the tickers share the same dates this is simply the
+  dates x tickers matrix; otherwise each column still holds the ticker's own history without gaps, which is
+  exactly what the per-ticker groupby of the pandas pipeline sees. The rows below a ticker's history are nan.
+  """
+  def __init__(self, index: pd.MultiIndex):
+    dates = index.get_level_values(0).to_numpy()
+    self.ticker_codes, self.tickers = pd.factorize(index.get_level_values(1), sort = True)
+
+    # Sort the rows by ticker and date, and number them within each ticker
+    order = np.lexsort((dates, self.ticker_codes))
+    self.counts = np.bincount(self.ticker_codes, minlength = len(self.tickers))
+    starts = np.repeat(np.cumsum(self.counts) - self.counts, self.counts)
+    self.rows = np.empty(len(index), dtype = np.intp)
+    self.rows[order] = np.arange(len(index)) - starts
+
+    self.shape = (int(self.counts.max(initial = 0)), len(self.tickers))
+    # Which cells of the 2D array hold a row of the dataframe
+    self.valid = np.arange(self.shape[0])[:, None] < self.counts
+
+  def pack(self, values):
+    """ Move the values of the dataframe rows to their place in the 2D array """
+    array = np.full(self.shape, np.nan)
+    array[self.rows, self.ticker_codes] = values
+    return array
+
+  def unpack(self, array):
+    """ Take back the values of the 2D array in the order of the dataframe rows """
+    return array[self.rows, self.ticker_codes]
+
+def compact(dataframe):
+  """
+  Store the float columns of a (date, ticker) dataframe as float32, and drop the unused levels of the index,
+  whose tickers are already kept as integer codes
+  """
+  dataframe = dataframe.astype({column: np.float32 for column in dataframe.columns if dataframe[column].dtype == np.float64})
+  dataframe.index = dataframe.index.remove_unused_levels()
+  return dataframe
+
+def monthly_data(dataframe):
+  """
+  The same monthly frame as DataFrame.get_monthly_data, grouping the daily rows by month and ticker codes
+  instead of unstacking, resampling and stacking the whole dataframe
+  """
+  last_cols = [c for c in dataframe.columns.unique(0) if c not in ['dollar_volume', 'volume', 'open', 'high', 'low', 'close']]
+  months = dataframe.index.get_level_values('date').to_period('M').to_timestamp(how = 'end').normalize()
+  grouped = dataframe.groupby([months.rename('date'), dataframe.index.get_level_values('ticker')])
+  return pd.concat([grouped['dollar_volume'].mean(), grouped[last_cols].last()], axis = 1).dropna()
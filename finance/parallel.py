@@ -0,0 +1,62 @@
+""" Run the per-ticker stages of the algotrading pipeline on shards of tickers, in a pool of processes """
+import concurrent.futures
+import os
+from multiprocessing import shared_memory
+import numpy as np
+
+def _shared_array(shape):
+  """ Create a float array in a new block of shared memory """
+  memory = shared_memory.SharedMemory(create = True, size = max(1, int(np.prod(shape))) * 8)
+  return memory, np.ndarray(shape, dtype = np.float64, buffer = memory.buf)
+
+def _run_shard(kernel, inputs_name, outputs_name, columns, outputs, shape, start, stop, counts):
+  """ Run the kernel on the tickers from start to stop, reading and writing the shared arrays in place """
+  inputs_memory = shared_memory.SharedMemory(name = inputs_name)
+  outputs_memory = shared_memory.SharedMemory(name = outputs_name)
+  try:
+    inputs = np.ndarray((len(columns), *shape), dtype = np.float64, buffer = inputs_memory.buf)
+    results = np.ndarray((len(outputs), *shape), dtype = np.float64, buffer = outputs_memory.buf)
+    prices = {column: np.ascontiguousarray(inputs[i, :, start:stop]) for i, column in enumerate(columns)}
+    valid = np.arange(shape[0])[:, None] < counts
+    computed = kernel(prices, valid)
+    for i, output in enumerate(outputs):
+      results[i, :, start:stop] = computed[output]
+    # The views must go before the memory is closed
+    del inputs, results
+  finally:
+    inputs_memory.close()
+    outputs_memory.close()
+
+def run_sharded(kernel, panel, prices: dict, outputs: list, max_workers = None, shards = None):
+  """
+  Run kernel(prices, valid) -> {output: array} on Panel arrays, split into shards of tickers across a process
+  pool. The prices are {column: values in the order of the dataframe rows}, and so are the returned outputs.
+  The arrays go through shared memory, so nothing but the shard bounds is pickled.
+  """
+  max_workers = max_workers or os.cpu_count()
+  # A few shards per worker, so that the faster workers pick up more of them
+  shards = shards or 4 * max_workers
+  rows, tickers = panel.shape
+  inputs_memory, inputs = _shared_array((len(prices), rows, tickers))
+  outputs_memory, results = _shared_array((len(outputs), rows, tickers))
+  try:
+    inputs.fill(np.nan)
+    results.fill(np.nan)
+    for i, values in enumerate(prices.values()):
+      inputs[i, panel.rows, panel.ticker_codes] = values
+
+    bounds = np.unique(np.linspace(0, tickers, min(shards, tickers) + 1).astype(int))
+    with concurrent.futures.ProcessPoolExecutor(max_workers = max_workers) as pool:
+      futures = [pool.submit(_run_shard, kernel, inputs_memory.name, outputs_memory.name, list(prices), outputs,
+                             (rows, tickers), start, stop, panel.counts[start:stop])
+                 for start, stop in zip(bounds[:-1], bounds[1:])]
+      for future in futures:
+        future.result()
+
+    # Take the results back in the order of the dataframe rows
+    return {output: panel.unpack(results[i]) for i, output in enumerate(outputs)}
+  finally:
+    del inputs, results
+    for memory in (inputs_memory, outputs_memory):
+      memory.close()
+      memory.unlink()
@@ -0,0 +1,157 @@
+""" Per-stage instrumentation of the algotrading pipeline: time, memory and size of each stage and indicator """
+import contextlib
+import cProfile
+import functools
+import io
+import json
+import os
+import pstats
+import sys
+import time
+import tracemalloc
+
+try:
+  import resource
+except ImportError:
+  # Not available on Windows, the peak RSS is then not recorded
+  resource = None
+
+def peak_rss():
+  """ Return the peak resident set size of the process so far, in bytes """
+  if resource is None:
+    return None
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  # Linux reports kilobytes, macOS bytes
+  return peak if sys.platform == 'darwin' else peak * 1024
+
+class Profiler:
+  """
+  Record the wall time, CPU time, peak RSS and the rows and columns of the dataframe after each stage.
+  The peak RSS only grows over the life of the process, so a stage shows it only when it raised it.
+  With capture, each top level stage also runs under cProfile and tracemalloc records the peak of the
+  Python allocations of every stage, at the price of a much slower run
+  """
+  def __init__(self, capture = False, metadata: dict = None):
+    self.capture = capture
+    self.metadata = metadata or {}
+    self.records = []
+    self.profiles = {}
+    self._stack = []
+    self._origin = time.perf_counter()
+
+  def __str__(self):
+    lines = [f"{'stage':40s} {'wall s':>8s} {'cpu s':>8s} {'rss MiB':>8s} {'rows':>10s} {'cols':>5s}"]
+    for record in self.stages():
+      name = '  ' * record['depth'] + record['name']
+      rss = record['peak_rss'] / 2**20 if record['peak_rss'] is not None else float('nan')
+      rows, cols = record['shape'] or ('', '')
+      line = f"{name:40s} {record['wall']:8.3f} {record['cpu']:8.3f} {rss:8.1f} {rows:>10} {cols:>5}"
+      if 'traced_peak' in record:
+        line += f" traced peak {record['traced_peak'] / 2**20:.1f} MiB"
+      lines.append(line)
+    return '\n'.join(lines)
+
+  @contextlib.contextmanager
+  def stage(self, name, target = None, category = 'stage', shape = None):
+    """ Record the block as a stage, with the shape of target.dataframe at its end, or the given (rows, columns) """
+    depth = len(self._stack)
+    frame = {'traced_peak': 0}
+    profile = None
+    if self.capture:
+      if not tracemalloc.is_tracing():
+        tracemalloc.start()
+      if self._stack:
+        # The peak so far belongs to the parent stage, the child starts its own
+        parent = self._stack[-1]
+        parent['traced_peak'] = max(parent['traced_peak'], tracemalloc.get_traced_memory()[1])
+      tracemalloc.reset_peak()
+      # cProfile cannot be nested, the children of a stage show up in its profile
+      if depth == 0:
+        profile = cProfile.Profile()
+    self._stack.append(frame)
+
+    start_wall, start_cpu = time.perf_counter(), time.process_time()
+    if profile is not None:
+      profile.enable()
+    try:
+      yield
+    finally:
+      if profile is not None:
+        profile.disable()
+      wall, cpu = time.perf_counter() - start_wall, time.process_time() - start_cpu
+      self._stack.pop()
+      dataframe = getattr(target, 'dataframe', None)
+      if shape is None and dataframe is not None:
+        shape = dataframe.shape
+      record = {'name': name,
+                'category': category,
+                'depth': depth,
+                'start': start_wall - self._origin,
+                'wall': wall,
+                'cpu': cpu,
+                'peak_rss': peak_rss(),
+                'shape': tuple(int(size) for size in shape) if shape is not None else None}
+      if self.capture:
+        record['traced_peak'] = max(frame['traced_peak'], tracemalloc.get_traced_memory()[1])
+        if self._stack:
+          self._stack[-1]['traced_peak'] = max(self._stack[-1]['traced_peak'], record['traced_peak'])
+        elif tracemalloc.is_tracing():
+          tracemalloc.stop()
+      if profile is not None:
+        self.profiles[f'{len(self.records)}:{name}'] = profile
+      self.records.append(record)
+
+  def stages(self):
+    """ Return the records in the order the stages started, each parent before its children """
+    return sorted(self.records, key = lambda record: record['start'])
+
+  def top_functions(self, key, limit = 20):
+    """ Return the text report of the limit functions with the highest cumulative time of a captured stage """
+    stream = io.StringIO()
+    stats = pstats.Stats(self.profiles[key], stream = stream)
+    stats.sort_stats('cumulative').print_stats(limit)
+    return stream.getvalue()
+
+  def to_dict(self):
+    return {'metadata': self.metadata,
+            'stages': self.stages(),
+            'profiles': {key: self.top_functions(key) for key in self.profiles}}
+
+  def to_json(self, path):
+    """ Write the records, and the cProfile reports of a capture, to a json file """
+    with open(path, 'w') as file:
+      json.dump(self.to_dict(), file, indent = 2)
+
+  def to_chrome_trace(self, path):
+    """ Write the records as complete events of the Chrome trace format, to open in chrome://tracing or Perfetto """
+    events = [{'name': record['name'],
+               'cat': record['category'],
+               'ph': 'X',
+               'ts': record['start'] * 1e6,
+               'dur': record['wall'] * 1e6,
+               'pid': os.getpid(),
+               'tid': 0,
+               'args': {key: value for key, value in record.items() if key not in ['name', 'category', 'start', 'wall']}}
+              for record in self.records]
+    with open(path, 'w') as file:
+      json.dump({'traceEvents': events, 'metadata': self.metadata}, file)
+
+  def dump_stats(self, directory):
+    """ Write the cProfile stats of each captured stage to a .prof file, e.g. for snakeviz """
+    os.makedirs(directory, exist_ok = True)
+    for key, profile in self.profiles.items():
+      profile.dump_stats(os.path.join(directory, key.replace(':', '_') + '.prof'))
+
+def stage(profiler, name, target = None, category = 'stage', shape = None):
+  """ The stage of the profiler, or nothing when there is no profiler """
+  if profiler is None:
+    return contextlib.nullcontext()
+  return profiler.stage(name, target, category, shape)
+
+def profiled(method):
+  """ Record the method as a stage of the profiler attribute of its object, if any """
+  @functools.wraps(method)
+  def wrapper(self, *args, **kwargs):
+    with stage(getattr(self, 'profiler', None), method.__name__, self):
+      return method(self, *args, **kwargs)
+  return wrapper
@@ -0,0 +1,191 @@
+""" Local, incremental store of the daily OHLCV data used by the algotrading pipeline """
+import glob
+import json
+import os
+import zlib
+import numpy as np
+import pandas as pd
+
+class Source:
+  """ Where the store gets the symbols and the prices from """
+
+  def symbols(self):
+    """ Return the list of tickers of the universe """
+    raise NotImplementedError
+
+  def download(self, tickers, start, end):
+    """ Return the OHLCV of the tickers from start (included) to end (excluded), as a (date, ticker) dataframe """
+    raise NotImplementedError
+
+class YahooSource(Source):
+  """ Take the S&P 500 symbols from Wikipedia and the prices from Yahoo Finance """
+  def __init__(self, stock_link = 'https://en.wikipedia.org/wiki/List_of_S%26P_500_companies'):
+    self.stock_link = stock_link
+
+  def symbols(self):
+    return pd.read_html(self.stock_link)[0]['Symbol'].str.replace('.', '-', regex = False).unique().tolist()
+
+  def download(self, tickers, start, end):
+    import yfinance as yf
+    dataframe = yf.download(tickers = tickers, start = start, end = end).stack()
+    dataframe.index.names = ['date', 'ticker']
+    dataframe.columns = dataframe.columns.str.lower()
+    return dataframe
+
+class LocalSource(Source):
+  """ Read the prices from a directory with one <ticker>.csv per ticker, e.g. for tests or offline fixtures """
+  def __init__(self, directory):
+    self.directory = directory
+
+  def symbols(self):
+    return sorted(os.path.splitext(os.path.basename(path))[0] for path in glob.glob(os.path.join(self.directory, '*.csv')))
+
+  def download(self, tickers, start, end):
+    frames = {}
+    for ticker in tickers:
+      path = os.path.join(self.directory, f'{ticker}.csv')
+      if os.path.exists(path):
+        prices = pd.read_csv(path, index_col = 'date', parse_dates = ['date'])
+        frames[ticker] = prices[(prices.index >= start) & (prices.index < end)]
+    if not frames:
+      return pd.DataFrame()
+    dataframe = pd.concat(frames, names = ['ticker', 'date']).swaplevel().sort_index()
+    dataframe.columns = dataframe.columns.str.lower()
+    return dataframe
+
+class SyntheticSource(Source):
+  """
+  Generate random walk OHLCV data, to run the pipeline offline. The prices of a ticker on a date do not depend
+  on the requested range nor on the other tickers, and some tickers are listed later than others
+  """
+  def __init__(self, n_tickers = 500, seed = 42, origin = '2000-01-03'):
+    self.n_tickers = n_tickers
+    self.seed = seed
+    self.origin = pd.Timestamp(origin)
+
+  def symbols(self):
+    return [f'T{i:04d}' for i in range(self.n_tickers)]
+
+  def _prices(self, ticker, dates):
+    rng = np.random.default_rng([self.seed, zlib.crc32(ticker.encode())])
+    n = len(dates)
+    close = 100 * np.exp(np.cumsum(rng.normal(0.0003, 0.02, n)))
+    opening = np.concatenate([[100], close[:-1]]) * np.exp(rng.normal(0, 0.005, n))
+    high = np.maximum(opening, close) * np.exp(np.abs(rng.normal(0, 0.01, n)))
+    low = np.minimum(opening, close) * np.exp(-np.abs(rng.normal(0, 0.01, n)))
+    prices = pd.DataFrame({'adj close': close * np.linspace(0.8, 1, n),
+                           'close': close,
+                           'high': high,
+                           'low': low,
+                           'open': opening,
+                           'volume': rng.lognormal(13, 0.5, n).round()},
+                          index = pd.Index(dates, name = 'date'))
+    # One ticker out of five is listed later
+    listing = rng.integers(0, n) if rng.random() < 0.2 else 0
+    return prices.iloc[listing:]
+
+  def download(self, tickers, start, end):
+    dates = pd.bdate_range(self.origin, end, inclusive = 'left')
+    frames = {ticker: self._prices(ticker, dates).loc[start:] for ticker in tickers}
+    return pd.concat(frames, names = ['ticker', 'date']).swaplevel().sort_index()
+
+class OHLCVStore:
+  """
+  Keep the OHLCV data in one parquet file per ticker, sorted by date, and remember which date range
+  has already been asked to the source for each ticker, so that updates only download the missing ranges
+  """
+  def __init__(self, root, source = None, offline = False):
+    self.root = root
+    self.source = source or YahooSource()
+    self.offline = offline
+    os.makedirs(os.path.join(self.root, 'prices'), exist_ok = True)
+    self.coverage = self._read_json('coverage.json', {})
+
+  def __str__(self):
+    return f"OHLCV store in {self.root} with {len(self.coverage)} tickers"
+
+  def _read_json(self, name, default):
+    path = os.path.join(self.root, name)
+    if not os.path.exists(path):
+      return default
+    with open(path) as file:
+      return json.load(file)
+
+  def _write_json(self, name, content):
+    # Write to a temporary file first, so that an interrupted run never leaves a broken file behind
+    path = os.path.join(self.root, name)
+    with open(path + '.tmp', 'w') as file:
+      json.dump(content, file)
+    os.replace(path + '.tmp', path)
+
+  def _path(self, ticker):
+    return os.path.join(self.root, 'prices', f'{ticker}.parquet')
+
+  def symbols(self, refresh = False):
+    """ Return the symbols of the universe, asking the source only the first time or when refreshing """
+    symbols = self._read_json('symbols.json', None)
+    if symbols is None or (refresh and not self.offline):
+      if self.offline:
+        raise RuntimeError("The symbols are not in the store and the store is offline")
+      symbols = self.source.symbols()
+      self._write_json('symbols.json', symbols)
+    return symbols
+
+  def missing(self, tickers, start, end):
+    """ Return {(start, end): [tickers]} with the date ranges not yet asked to the source """
+    start, end = pd.Timestamp(start), pd.Timestamp(end)
+    missing = {}
+    for ticker in tickers:
+      if ticker not in self.coverage:
+        ranges = [(start, end)]
+      else:
+        first, last = map(pd.Timestamp, self.coverage[ticker])
+        # Extend the covered range on both sides, so that it always stays a single interval
+        ranges = []
+        if start < first:
+          ranges.append((start, first))
+        if end > last:
+          ranges.append((last, end))
+      for date_range in ranges:
+        missing.setdefault(date_range, []).append(ticker)
+    return missing
+
+  def update(self, tickers, start, end):
+    """ Download only the date ranges which are not in the store yet, one request per range for all its tickers.
+    Only the tickers which got rows are covered, the others are asked again by the next update """
+    if self.offline:
+      return
+    for (range_start, range_end), range_tickers in self.missing(tickers, start, end).items():
+      dataframe = self.source.download(range_tickers, range_start, range_end)
+      downloaded = {} if dataframe.empty else dict(tuple(dataframe.groupby(level = 'ticker')))
+      for ticker in range_tickers:
+        # A ticker without rows may have failed, e.g. yfinance gives failed and rate limited tickers as empty
+        # columns, so its range stays missing and is asked again on the next update
+        if ticker not in downloaded:
+          continue
+        self._merge(ticker, downloaded[ticker].droplevel('ticker'))
+        first, last = self.coverage.get(ticker, (range_start.isoformat(), range_end.isoformat()))
+        self.coverage[ticker] = [min(pd.Timestamp(first), range_start).isoformat(),
+                                 max(pd.Timestamp(last), range_end).isoformat()]
+      self._write_json('coverage.json', self.coverage)
+
+  def _merge(self, ticker, prices):
+    """ Add the new prices of a ticker to its file """
+    path = self._path(ticker)
+    if os.path.exists(path):
+      prices = pd.concat([pd.read_parquet(path), prices])
+      prices = prices[~prices.index.duplicated(keep = 'last')]
+    prices.sort_index().to_parquet(path)
+
+  def load(self, tickers, start, end, columns = None):
+    """ Read the tickers from start (included) to end (excluded) as a (date, ticker) dataframe """
+    start, end = pd.Timestamp(start), pd.Timestamp(end)
+    frames = {}
+    for ticker in tickers:
+      path = self._path(ticker)
+      if os.path.exists(path):
+        prices = pd.read_parquet(path, columns = columns)
+        frames[ticker] = prices[(prices.index >= start) & (prices.index < end)]
+    if not frames:
+      raise KeyError("None of the tickers is in the store")
+    return pd.concat(frames, names = ['ticker', 'date']).swaplevel().sort_index()
@@ -0,0 +1,234 @@
+""" Incremental updates of the algotrading features, one daily bar per ticker at a time """
+import numpy as np
+import pandas as pd
+from indicators import garman_klass, output_columns
+from panel import Panel
+
+# The price columns of a daily bar
+PRICE_COLUMNS = ['adj close', 'close', 'high', 'low', 'open', 'volume']
+
+class RunningStats:
+  """ Running mean and standard deviation of each ticker, with Welford's algorithm """
+  def __init__(self, n):
+    self.count = np.zeros(n)
+    self.mean = np.zeros(n)
+    self.m2 = np.zeros(n)
+
+  def add(self, values):
+    """ Add the values which are not nan """
+    valid = ~np.isnan(values)
+    self.count += valid
+    delta = np.where(valid, values - self.mean, 0)
+    self.mean += np.divide(delta, self.count, out = np.zeros_like(delta), where = valid)
+    self.m2 += np.where(valid, delta * (values - self.mean), 0)
+
+  def standardize(self, values):
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+      return (values - self.mean) / np.sqrt(self.m2 / (self.count - 1))
+
+class IndicatorState:
+  """
+  Rolling state of the indicators of DataFrame.get_tech_indicators for every ticker: the ewm sums of RSI and ATR,
+  the EMAs of MACD, the window of the Bollinger bands and the previous closes. A new bar updates it in O(tickers).
+  ATR and MACD are standardized with the mean and std of all the values seen so far, while the batch pipeline
+  uses the whole history, future included, so the two agree only on the last bar.
+  """
+  def __init__(self, tickers, lista: list, periods = 20, fast = 12, slow = 26):
+    self.tickers = pd.Index(tickers, name = 'ticker')
+    self.lista = lista
+    self.periods = periods
+    self.fast = fast
+    self.slow = slow
+    n = len(self.tickers)
+    self.count = np.zeros(n, dtype = np.int64)
+    self.previous_adj_close = np.full(n, np.nan)
+    self.previous_close = np.full(n, np.nan)
+    # RSI: ewm numerators of the gains and losses, their denominators are the same and cancel out
+    self.gains = np.zeros(n)
+    self.losses = np.zeros(n)
+    self.rsi_count = np.zeros(n, dtype = np.int64)
+    # Bollinger bands: the last values of log1p(adj close)
+    self.window = np.full((periods, n), np.nan)
+    # ATR: ewm of the true range
+    self.true_ranges = np.zeros(n)
+    self.atr_weights = np.zeros(n)
+    self.atr_count = np.zeros(n, dtype = np.int64)
+    self.atr_stats = RunningStats(n)
+    # MACD: the fast and slow EMAs, which start from the average of their first values
+    self.fast_ema = np.zeros(n)
+    self.slow_ema = np.zeros(n)
+    self.macd_stats = RunningStats(n)
+
+  @classmethod
+  def from_dataframe(cls, dataframe, lista: list, periods = 20):
+    """ Build the state from the history of a (date, ticker) dataframe of prices, replaying it bar by bar """
+    panel = Panel(dataframe.index)
+    state = cls(panel.tickers, lista, periods)
+    prices = {column: panel.pack(dataframe[column].to_numpy(dtype = np.float64)) for column in PRICE_COLUMNS}
+    # The i-th row of the panel holds the i-th bar of every ticker
+    for i in range(panel.shape[0]):
+      state._step({column: values[i] for column, values in prices.items()}, panel.valid[i])
+    return state
+
+  def _ewm(self, numerator, weights, count, values, present):
+    """ One step of an ewm with adjust = True and alpha = 1 / periods, for the tickers with a value """
+    valid = present & ~np.isnan(values)
+    decay = 1 - 1 / self.periods
+    numerator[valid] = decay * numerator[valid] + values[valid]
+    weights[valid] = decay * weights[valid] + 1
+    count[valid] += 1
+
+  def _ema(self, ema, length, values, present):
+    """ One step of the pandas_ta EMA, for the tickers with a value """
+    alpha = 2 / (length + 1)
+    # Up to the length-th bar, keep the sum of the values for the seed
+    seeding = present & (self.count <= length)
+    ema[seeding] += values[seeding]
+    seeded = present & (self.count == length)
+    ema[seeded] /= length
+    running = present & (self.count > length)
+    ema[running] = (1 - alpha) * ema[running] + alpha * values[running]
+    return np.where(self.count >= length, ema, np.nan)
+
+  def _step(self, bar: dict, present):
+    """ Add one bar to the state of the tickers which are present, and return the indicators of all the tickers """
+    periods = self.periods
+    self.count += present
+    columns = {}
+
+    # RSI
+    change = bar['adj close'] - self.previous_adj_close
+    valid = present & ~np.isnan(change)
+    decay = 1 - 1 / periods
+    self.gains[valid] = decay * self.gains[valid] + np.maximum(change[valid], 0)
+    self.losses[valid] = decay * self.losses[valid] + np.minimum(change[valid], 0)
+    self.rsi_count[valid] += 1
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+      rsi = 100 * self.gains / (self.gains + np.abs(self.losses))
+    columns['rsi'] = np.where(self.rsi_count >= periods, rsi, np.nan)
+
+    # Bollinger bands, the window is a ring buffer indexed by the number of bars
+    row = (self.count - 1) % periods
+    tickers = np.flatnonzero(present)
+    self.window[row[tickers], tickers] = np.log1p(bar['adj close'][tickers])
+    mid = self.window.mean(axis = 0)
+    deviations = 2 * self.window.std(axis = 0)
+    full = self.count >= periods
+    columns['bb_low'] = np.where(full, mid - deviations, np.nan)
+    columns['bb_mid'] = np.where(full, mid, np.nan)
+    columns['bb_high'] = np.where(full, mid + deviations, np.nan)
+
+    # ATR
+    true_range = np.fmax(np.fmax(np.abs(bar['high'] - bar['low']), np.abs(bar['high'] - self.previous_close)),
+                         np.abs(self.previous_close - bar['low']))
+    true_range[np.isnan(self.previous_close)] = np.nan
+    self._ewm(self.true_ranges, self.atr_weights, self.atr_count, true_range, present)
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+      atr = np.where(present & (self.atr_count >= periods), self.true_ranges / self.atr_weights, np.nan)
+    self.atr_stats.add(atr)
+    columns['atr'] = self.atr_stats.standardize(atr)
+
+    # MACD
+    macd = np.where(present, self._ema(self.fast_ema, self.fast, bar['close'], present) -
+                             self._ema(self.slow_ema, self.slow, bar['close'], present), np.nan)
+    self.macd_stats.add(macd)
+    columns['macd'] = self.macd_stats.standardize(macd)
+
+    columns['garman_klass'] = garman_klass(bar['high'], bar['low'], bar['adj close'], bar['open'])
+
+    self.previous_adj_close = np.where(present, bar['adj close'], self.previous_adj_close)
+    self.previous_close = np.where(present, bar['close'], self.previous_close)
+    return {column: np.where(present, columns[column], np.nan) for column in output_columns(self.lista)}
+
+  def update(self, bars: pd.DataFrame):
+    """
+    Add the bars of a new day, a dataframe of prices indexed by ticker, and return them with the dollar volume
+    and the indicators, like the rows of DataFrame.dataframe after get_tech_indicators
+    """
+    new_tickers = bars.index.difference(self.tickers)
+    if len(new_tickers):
+      raise KeyError(f"Tickers without a state: {new_tickers.tolist()}")
+    prices = bars[PRICE_COLUMNS].reindex(self.tickers)
+    present = prices.notna().any(axis = 1).to_numpy()
+    columns = self._step({column: prices[column].to_numpy(dtype = np.float64) for column in PRICE_COLUMNS}, present)
+
+    rows = bars[PRICE_COLUMNS].copy()
+    rows['dollar_volume'] = (rows['adj close'] * rows['volume']) / 1e6
+    positions = self.tickers.get_indexer(rows.index)
+    for column, values in columns.items():
+      rows[column] = values[positions]
+    return rows
+
+class MonthlyState:
+  """
+  Running state of DataFrame.get_monthly_data and DataFrame.filtering: the dollar volume sum and the last values
+  of the current month, and the 60 monthly dollar volumes behind dollar_volume_5. A new bar updates it in O(tickers),
+  and the first bar of a new month closes the previous one.
+  """
+  def __init__(self, tickers, columns: list, months = 5*12):
+    self.tickers = pd.Index(tickers, name = 'ticker')
+    self.columns = columns
+    self.months = months
+    n = len(self.tickers)
+    self.month = None
+    self.dollar_volume = np.zeros(n)
+    self.days = np.zeros(n)
+    self.last = {column: np.full(n, np.nan) for column in columns}
+    # The monthly dollar volumes as a ring buffer, nan for the months a ticker was dropped
+    self.history = np.full((months, n), np.nan)
+    self.closed = 0
+
+  @classmethod
+  def from_dataframe(cls, dataframe):
+    """ Build the state from the daily dataframe after get_tech_indicators, replaying it day by day """
+    columns = [c for c in dataframe.columns.unique(0) if c not in ['dollar_volume', 'volume', 'open', 'high', 'low', 'close']]
+    wide = dataframe[['dollar_volume'] + columns].unstack('ticker')
+    state = cls(wide['dollar_volume'].columns, columns)
+    arrays = {column: wide[column].to_numpy(dtype = np.float64) for column in ['dollar_volume'] + columns}
+    for i, date in enumerate(wide.index):
+      state._step(date, {column: values[i] for column, values in arrays.items()})
+    return state
+
+  def _close_month(self):
+    """ Return the monthly rows of the current month, as get_monthly_data and filtering compute them """
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+      values = {'dollar_volume': self.dollar_volume / self.days, **self.last}
+    month = pd.DataFrame(values, index = self.tickers)
+    # get_monthly_data drops the incomplete rows, which then count as missing in the rolling average
+    complete = month.notna().all(axis = 1).to_numpy()
+    self.history[self.closed % self.months] = np.where(complete, values['dollar_volume'], np.nan)
+    self.closed += 1
+    month['dollar_volume_5'] = self.history.mean(axis = 0) if self.closed >= self.months else np.nan
+    month = month[complete]
+    month = month.assign(dollar_volume_5_rank = month['dollar_volume_5'].rank(ascending = False))
+    month.index = pd.MultiIndex.from_product([[self.month.to_timestamp(how = 'end').normalize()], month.index],
+                                             names = ['date', 'ticker'])
+    return month
+
+  def _step(self, date, row: dict):
+    """ Add one day of rows, return the closed month if the day starts a new one """
+    closed = None
+    month = pd.Period(date, freq = 'M')
+    if self.month is not None and month != self.month:
+      closed = self._close_month()
+      self.dollar_volume[:] = 0
+      self.days[:] = 0
+      for values in self.last.values():
+        values[:] = np.nan
+    self.month = month
+
+    valid = ~np.isnan(row['dollar_volume'])
+    self.dollar_volume[valid] += row['dollar_volume'][valid]
+    self.days += valid
+    for column in self.columns:
+      valid = ~np.isnan(row[column])
+      self.last[column][valid] = row[column][valid]
+    return closed
+
+  def update(self, date, rows: pd.DataFrame):
+    """
+    Add the daily rows of a date, as returned by IndicatorState.update. When the date starts a new month, return
+    the closed month with dollar_volume_5 and its rank, filtering keeps the rows ranked below 150
+    """
+    rows = rows.reindex(self.tickers)
+    return self._step(date, {column: rows[column].to_numpy(dtype = np.float64) for column in ['dollar_volume'] + self.columns})
@@ -1,33 +1,191 @@
+import os
+import asyncio
+import functools
+import tempfile
+import weakref
+import joblib
 import streamlit as st
 import numpy as np
 import pandas as pd
 from sklearn import datasets
 from sklearn.ensemble import RandomForestClassifier
+from base_app import BaseApp, memoized
+
+# The fitted model is saved next to the app, so that a restart loads it instead of training again
+MODEL_PATH = os.environ.get('IRIS_MODEL', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'iris_model.joblib'))
+FEATURES = ['sepal_length', 'sepal_width', 'petal_length', 'petal_width']
+# The names of the classes 0, 1 and 2 of the iris dataset
+CLASSES = ['setosa', 'versicolor', 'virginica']
 
 class MachineLearningModel():
-    def __init__(self):
-        self.model = RandomForestClassifier()
-        
+    def __init__(self, random_state = 42):
+        self.model = RandomForestClassifier(random_state = random_state)
+        self._predict_row = functools.lru_cache(maxsize = 4096)(self._predict_row)
+
     def import_data(self):
         iris = datasets.load_iris()
-        X = iris.data
+        X = pd.DataFrame(iris.data, columns = FEATURES)
         y = iris.target
         return X, y
-        
+
     def fit(self, x_data, y_data):
         self.model.fit(x_data, y_data)
-        
+        self._predict_row.cache_clear()
+
     def model_run(self):
         X, y = self.import_data()
-        self.fit(X, y)  
-        
+        self.fit(X, y)
+
     def predict(self, dataframe):
-        prediction = self.model.predict(dataframe)
-        prediction = self.model.predict_proba(dataframe)
-        return prediction
-    
-class WebSite():
+        """
+        Return the probability of each class for each row of the dataframe
+        """
+        return self.model.predict_proba(dataframe[FEATURES])
+
+    def predict_chunks(self, chunks, n_jobs = -1):
+        """
+        Score an iterable of dataframes one at a time, with the trees split over n_jobs threads, and yield
+        for each one a dataframe with the probability of each class and the predicted class
+        """
+        with joblib.parallel_config(n_jobs = n_jobs):
+            for chunk in chunks:
+                probabilities = pd.DataFrame(self.predict(chunk), columns = CLASSES, index = chunk.index)
+                probabilities['prediction'] = np.array(CLASSES)[probabilities.to_numpy().argmax(axis = 1)]
+                yield probabilities
+
+    def predict_csv(self, file, chunksize = 100_000, n_jobs = -1):
+        """
+        Score a csv with the FEATURES columns, read chunksize rows at a time so that a file of millions
+        of rows never sits whole in memory. The trees work in float32, so the features are read as float32
+        """
+        chunks = pd.read_csv(file, usecols = FEATURES, dtype = np.float32, chunksize = chunksize)
+        return self.predict_chunks(chunks, n_jobs)
+
+    def _predict_row(self, row):
+        return self.model.predict_proba(pd.DataFrame([row], columns = FEATURES))
+
+    def predict_one(self, features):
+        """
+        Return the probabilities of a single flower, given as {feature: value}. The sliders move by steps,
+        so the same inputs come back often and are answered from a cache
+        """
+        return self._predict_row(tuple(float(features[feature]) for feature in FEATURES))
+
+    def save(self, path = MODEL_PATH):
+        # Write to a temporary file first, so that another process never loads a half written model
+        joblib.dump(self.model, path + '.tmp')
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path = MODEL_PATH):
+        model = cls()
+        model.model = joblib.load(path)
+        return model
+
+    @classmethod
+    def load_or_train(cls, path = MODEL_PATH):
+        """
+        Load the persisted model, or train it and persist it when there is none
+        """
+        if os.path.exists(path):
+            return cls.load(path)
+        model = cls()
+        model.model_run()
+        model.save(path)
+        return model
+
+    def warm_up(self):
+        """
+        Score one flower, so that the first user does not pay for the lazy initializations of the first prediction
+        """
+        X, _ = self.import_data()
+        self.predict(X.iloc[:1])
+        return self
+
+@memoized(max_entries = 1)
+def shared_model(path = MODEL_PATH):
+    """
+    The model of the process, trained or loaded once and shared by all the sessions and reruns
+    """
+    return MachineLearningModel.load_or_train(path).warm_up()
+
+class MicroBatcher():
+    """
+    Gather the single flowers asked by concurrent callers and score them with one vectorized call.
+    A batch is scored as soon as it has max_batch rows, or max_delay seconds after its first row
+    """
+    def __init__(self, model, max_batch = 256, max_delay = 0.002):
+        self.model = model
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.queue = None
+        self.worker = None
+
+    async def __aenter__(self):
+        self.queue = asyncio.Queue()
+        self.worker = asyncio.create_task(self._serve())
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.worker.cancel()
+        try:
+            await self.worker
+        except asyncio.CancelledError:
+            pass
+
+    async def predict(self, features):
+        """
+        Return the probabilities of a single flower, given as {feature: value}
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put(([features[feature] for feature in FEATURES], future))
+        return await future
+
+    async def _serve(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_delay
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            rows, futures = zip(*batch)
+            try:
+                # Score in a thread, the event loop keeps taking requests meanwhile
+                probabilities = await loop.run_in_executor(None, self.model.predict, pd.DataFrame(rows, columns = FEATURES))
+            except Exception as error:
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(error)
+                continue
+            for future, row in zip(futures, probabilities):
+                if not future.done():
+                    future.set_result(row)
+
+class ScoredUpload():
+    """
+    The predictions of an uploaded csv, in a temporary file removed with close, or when the session which
+    holds it is gone
+    """
+    def __init__(self, file_id):
+        self.file_id = file_id
+        self.counts = pd.Series(0, index = CLASSES)
+        self.preview = pd.DataFrame(columns = CLASSES + ['prediction'])
+        descriptor, self.path = tempfile.mkstemp(suffix = '.csv')
+        os.close(descriptor)
+        self._remove = weakref.finalize(self, os.remove, self.path)
+
+    def close(self):
+        self._remove()
+
+class WebSite(BaseApp):
     def __init__(self):
+        super().__init__()
         self.title = st.title('Simple Iris Flower Predictions')
         self.description = st.write('This app predicts the Iris flower type')
 
@@ -42,20 +200,71 @@ class WebSite():
                 'petal_width' : petal_width}
         features = pd.DataFrame(data, index = [0])
         return features
-    
+
     def body(self):
         st.subheader('User Input Parameters')
-        model = MachineLearningModel()
+        model = shared_model()
         df = self.user_input_features()
         st.write(df)
-        model.model_run()
-        prediction = model.predict(df)
-        
+        with self.render('prediction'):
+            prediction = model.predict_one(df.iloc[0])
+
         #st.subheader('Class labels and their corresponding index number')
         #st.write(iris.target_names)
 
         st.subheader('Prediction')
         st.write(prediction)
-        
-website = WebSite()
-website.body()
+
+    def batch_prediction(self, chunksize = 100_000):
+        """
+        Score an uploaded csv chunk by chunk, showing the progress and the first rows as they come,
+        and offer the scored file for download at the end. The scores of the last upload stay in a file of
+        the session, so the reruns of the sliders neither score the file again nor hold it in memory
+        """
+        st.subheader('Batch Prediction')
+        uploaded = st.file_uploader('Score a csv with the columns ' + ', '.join(FEATURES), type = 'csv')
+        scored = st.session_state.get('batch_prediction')
+        if uploaded is None:
+            if scored is not None:
+                scored.close()
+                del st.session_state['batch_prediction']
+            return
+        if scored is None or scored.file_id != uploaded.file_id:
+            if scored is not None:
+                scored.close()
+            scored = self.score_upload(uploaded, chunksize)
+            st.session_state['batch_prediction'] = scored
+        else:
+            st.write(f"{int(scored.counts.sum()):,} rows scored")
+            st.dataframe(scored.preview)
+        st.bar_chart(scored.counts)
+        # download_button reads the whole file into memory, only on the rerun which asks for it
+        if st.button('Prepare the download'):
+            with open(scored.path, 'rb') as file:
+                st.download_button('Download the predictions', file, file_name = 'predictions.csv', mime = 'text/csv')
+
+    def score_upload(self, uploaded, chunksize):
+        model = shared_model()
+        status = st.empty()
+        preview = st.empty()
+        scored = ScoredUpload(uploaded.file_id)
+        with open(scored.path, 'w') as output:
+            for i, chunk in enumerate(model.predict_csv(uploaded, chunksize)):
+                chunk.to_csv(output, header = i == 0, index = False)
+                scored.counts = scored.counts.add(chunk['prediction'].value_counts(), fill_value = 0)
+                status.write(f'{int(scored.counts.sum()):,} rows scored')
+                if i == 0:
+                    scored.preview = chunk.head(100)
+                    preview.dataframe(scored.preview)
+        return scored
+
+    def run(self):
+        self.body()
+        with self.render('batch prediction'):
+            self.batch_prediction()
+
+if __name__ == '__main__':
+    # Warm up the model before drawing the page, the first session of the process trains or loads it
+    shared_model()
+    website = WebSite()
+    website.main()
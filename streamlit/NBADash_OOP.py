@@ -1,12 +1,40 @@
 # Inspired by the Data Professor's "Build 12 Data Science Apps with Python and Streamlit - Full Course" video
 
+import os
 import streamlit as st
 import pandas as pd
 import base64
 import numpy as np
+from nba_store import FETCH_DELAY, FIRST_YEAR, LAST_YEAR, LocalSource, SeasonStore
+from nba_query import MultiSeasonTable
+from base_app import BaseApp, memoized
 
-class NBAWebsite():
+# Where the seasons are cached, and optionally a directory of saved pages to run without network
+STORE_PATH = os.environ.get('NBA_STORE', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'nba_seasons'))
+LOCAL_PATH = os.environ.get('NBA_LOCAL')
+
+@memoized(max_entries = 1)
+def season_store(root = STORE_PATH, local = LOCAL_PATH):
+    """
+    The season store of the process, whose in-memory seasons are shared by all the sessions
+    """
+    return SeasonStore(root, LocalSource(local) if local else None)
+
+@memoized(max_entries = 1)
+def all_seasons(root = STORE_PATH, local = LOCAL_PATH):
+    """
+    The table of the seasons, shared by all the sessions, and {year: error} of the seasons which could not be
+    fetched and are left out. The first time, the missing seasons are fetched a few at a time and as slowly as
+    by the command line of nba_store, after that the table is read from a single file of the store
+    """
+    store = season_store(root, local)
+    errors = store.prefetch(max_workers = 4, delay = 0 if local else FETCH_DELAY)
+    years = [year for year in range(FIRST_YEAR, LAST_YEAR + 1) if year not in errors]
+    return MultiSeasonTable.from_store(store, years, path = os.path.join(root, 'all_seasons.parquet')), errors
+
+class NBAWebsite(BaseApp):
     def __init__(self):
+        super().__init__()
         self.title = st.title("NBA Player Stats Explorer")
         self.markdown = st.markdown("""
                                     This app performs simple webscraping of NBA players' statistics
@@ -25,14 +53,10 @@ class NBAWebsite():
 
     def load_data(self, year):
         """
-        Create the dataset, filtered by the year returned by the sidebar
+        Create the dataset, filtered by the year returned by the sidebar. The season is read from the store,
+        so changing the team or the position does not download it again
         """
-        url = "https://www.basketball-reference.com/leagues/NBA_" + str(year) + "_per_game.html"
-        html = pd.read_html(url, header=0)
-        df = html[0]
-        raw = df.drop(df[df.Age == 'Age'].index)
-        raw = raw.fillna(0)
-        playerstats = raw.drop(['Rk'], axis = 1)
+        playerstats = season_store().season(year)
         return playerstats
     
     def team_selection(self, df):
@@ -51,13 +75,52 @@ class NBAWebsite():
         selected_pos = st.sidebar.multiselect('Position', sorted_unique_position)
         return selected_pos
 
-        
+
+    def all_seasons_view(self):
+        """
+        Display the top players of each year by a stat, and the career of a player, across the selected seasons
+        """
+        with self.render('load'):
+            with st.spinner('Loading all the seasons, the first time takes a few minutes'):
+                table, errors = all_seasons()
+        if errors:
+            st.warning(f"{len(errors)} seasons could not be loaded and are left out: "
+                       + ', '.join(f"{year} ({error})" for year, error in sorted(errors.items())))
+            if st.button('Retry'):
+                all_seasons.cache.clear()
+                st.rerun()
+        first, last = st.sidebar.slider('Years', FIRST_YEAR, LAST_YEAR, (FIRST_YEAR, LAST_YEAR))
+        selected_team = st.sidebar.multiselect('Team', list(table.indexes['Tm'].categories))
+        selected_position = st.sidebar.multiselect('Position', list(table.indexes['Pos'].categories))
+        stat = st.sidebar.selectbox('Stat', table.stats, index = table.stats.index('PTS') if 'PTS' in table.stats else 0)
+        n = st.sidebar.number_input('Top', 1, 50, 10)
+        years = range(first, last + 1)
+
+        # An empty selection keeps all the teams or positions
+        st.subheader(f"Top {n} players by {stat} per year")
+        with self.render('query'):
+            top = table.top(stat, n, years, selected_team or None, selected_position or None)
+        with self.render('table'):
+            st.dataframe(top[['Year', 'Player', 'Tm', 'Pos', stat]], hide_index = True)
+
+        player = st.selectbox('Career of', top['Player'].unique())
+        if player is not None:
+            st.subheader(f"{player}'s {stat} per year")
+            with self.render('line chart'):
+                self.line_chart(table.career(player, [stat]))
+
     def run(self):
+        # Choose between one season and all of them
+        if st.sidebar.radio('View', ['Season', 'All seasons']) == 'All seasons':
+            self.all_seasons_view()
+            return
+
         # Display the sidebar and return the year selected as a variable
         selected_year = self.sidebar()
         
         # Return a dataframe, whose year is filtered by the selected_year
-        df = self.load_data(selected_year)  
+        with self.render('load'):
+            df = self.load_data(selected_year)
         
         # Return the team chosen and display the selection box
         selected_team = self.team_selection(df)
@@ -66,13 +129,15 @@ class NBAWebsite():
         selected_position = self.position(df)
         
         # Once both filters have been chosen, filter the dataframe
-        if selected_team and selected_position:
-            df = df[df['Tm'].isin(selected_team) & df['Pos'].isin(selected_position)]
-        
+        with self.render('query'):
+            if selected_team and selected_position:
+                df = df[df['Tm'].isin(selected_team) & df['Pos'].isin(selected_position)]
+
         # Display the dataframe
-        st.write(df)
-        
+        with self.render('table'):
+            st.write(df)
+
 if __name__ == '__main__':
     app = NBAWebsite()
-    app.run()
+    app.main()
         
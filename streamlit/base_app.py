@@ -0,0 +1,193 @@
+""" What the Streamlit apps share: memoized loaders, timing of the renders and downsampling of large charts """
+import collections
+import contextlib
+import functools
+import inspect
+import os
+import sys
+import threading
+import time
+import numpy as np
+import pandas as pd
+import streamlit as st
+
+# The caches of the memoized loaders, by function. Streamlit executes the script of an app again on every rerun,
+# which defines its functions again, so the caches must live here to survive the reruns and be shared by the sessions
+_caches = {}
+_caches_lock = threading.Lock()
+
+def size_of(value):
+    """
+    Return the memory used by a value in bytes, exact for dataframes and arrays, shallow for the other objects
+    """
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return int(value.memory_usage(deep = True).sum()) if isinstance(value, pd.DataFrame) else int(value.memory_usage(deep = True))
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if hasattr(value, 'data') and isinstance(value.data, pd.DataFrame):
+        # An index or a table around a dataframe
+        return size_of(value.data)
+    return sys.getsizeof(value)
+
+class LoaderCache():
+    """
+    A thread safe LRU of the values of a loader, which evicts the least recently used values beyond
+    max_entries values or max_bytes bytes. A value is computed once even when many sessions ask for it at once
+    """
+    def __init__(self, max_entries = 16, max_bytes = None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.values = collections.OrderedDict()
+        self.sizes = {}
+        self.lock = threading.Lock()
+        self.key_locks = collections.defaultdict(threading.Lock)
+        self.hits = self.misses = 0
+
+    def info(self):
+        return {'entries': len(self.values), 'bytes': sum(self.sizes.values()), 'hits': self.hits, 'misses': self.misses}
+
+    def clear(self):
+        with self.lock:
+            self.values.clear()
+            self.sizes.clear()
+
+    def get(self, key, compute):
+        with self.lock:
+            if key in self.values:
+                self.values.move_to_end(key)
+                self.hits += 1
+                return self.values[key]
+            key_lock = self.key_locks[key]
+        with key_lock:
+            with self.lock:
+                # Another session may have computed it while this one waited
+                if key in self.values:
+                    self.hits += 1
+                    return self.values[key]
+            value = compute()
+            with self.lock:
+                self.misses += 1
+                self.values[key] = value
+                self.sizes[key] = size_of(value)
+                self._evict()
+                self.key_locks.pop(key, None)
+            return value
+
+    def _evict(self):
+        # The last value is always kept, even alone above max_bytes
+        while len(self.values) > 1 and (len(self.values) > self.max_entries or
+                                        (self.max_bytes is not None and sum(self.sizes.values()) > self.max_bytes)):
+            key, _ = self.values.popitem(last = False)
+            del self.sizes[key]
+
+def memoized(max_entries = 16, max_bytes = None):
+    """
+    Cache the values of a loader by its arguments, in one LoaderCache per process shared by all the sessions
+    and reruns. The values are shared, they must not be modified
+    """
+    def decorator(function):
+        name = f"{function.__module__}.{function.__qualname__}"
+        with _caches_lock:
+            cache = _caches.setdefault(name, LoaderCache(max_entries, max_bytes))
+        cache.max_entries, cache.max_bytes = max_entries, max_bytes
+        signature = inspect.signature(function)
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            # The defaults are part of the key, e.g. a path read from the environment
+            arguments = signature.bind(*args, **kwargs)
+            arguments.apply_defaults()
+            key = tuple(arguments.arguments.items())
+            return cache.get(key, lambda: function(*args, **kwargs))
+        wrapper.cache = cache
+        return wrapper
+    return decorator
+
+def downsample_rows(data, max_points = 2000):
+    """
+    Return at most max_points rows of a dataframe for a line chart, averaging the numeric columns over buckets of
+    consecutive rows and keeping the first value of the other columns, e.g. the dates of the x axis
+    """
+    if len(data) <= max_points:
+        return data
+    buckets = np.arange(len(data)) * max_points // len(data)
+    aggregations = {column: 'mean' if pd.api.types.is_numeric_dtype(data[column]) else 'first' for column in data.columns}
+    sampled = data.groupby(buckets).agg(aggregations)
+    # Each bucket takes the index of its first row
+    sampled.index = data.index[np.searchsorted(buckets, sampled.index)]
+    return sampled
+
+def downsample_points(data, max_points = 5000, latitude = 'latitude', longitude = 'longitude'):
+    """
+    Return the coordinates to draw on a map. Up to max_points points are drawn one by one, above that they are
+    counted on a grid of cells, as coarse as needed to have at most max_points cells, drawn by size
+    """
+    points = data[[latitude, longitude]].dropna()
+    if len(points) <= max_points:
+        return points
+    cell = 0.1
+    while True:
+        cells = (points / cell).round().astype(np.int32)
+        counts = cells.groupby([latitude, longitude]).size()
+        if len(counts) <= max_points:
+            break
+        cell *= 2
+    grid = counts.reset_index(name = 'count')
+    grid[[latitude, longitude]] *= cell
+    # The radius, in meters, grows with the square root of the count so that the area is proportional to it
+    grid['size'] = 2000 * np.sqrt(grid['count'])
+    return grid
+
+class BaseApp():
+    """
+    The base of the apps: subclasses draw the page in run, and main runs it with the timing of each render.
+    The sections of a page timed with render are kept in st.session_state['render_timings'], the last
+    one for each rerun, and shown in the sidebar when the environment variable APP_TIMINGS is set
+    """
+    def __init__(self, max_chart_points = 2000, max_map_points = 5000):
+        self.max_chart_points = max_chart_points
+        self.max_map_points = max_map_points
+        self.timings = {}
+
+    @contextlib.contextmanager
+    def render(self, name):
+        """
+        Time a section of the page
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0) + time.perf_counter() - start
+
+    def line_chart(self, data, x = None, y = None, **kwargs):
+        """
+        st.line_chart of a dataframe downsampled to max_chart_points rows
+        """
+        if x is not None:
+            data = data[[x] + ([y] if isinstance(y, str) else list(y if y is not None else data.columns.drop(x)))]
+        return st.line_chart(downsample_rows(data, self.max_chart_points), x = x, y = y, **kwargs)
+
+    def map(self, data, **kwargs):
+        """
+        st.map of the points of a dataframe, grouped on a grid above max_map_points
+        """
+        points = downsample_points(data, self.max_map_points)
+        if 'size' in points:
+            st.caption(f"{len(data):,} points, grouped in {len(points):,} areas")
+            return st.map(points, size = 'size', **kwargs)
+        return st.map(points, **kwargs)
+
+    def run(self):
+        raise NotImplementedError
+
+    def main(self):
+        """
+        Run the app and record how long each section took
+        """
+        with self.render('total'):
+            self.run()
+        st.session_state['render_timings'] = dict(self.timings)
+        if os.environ.get('APP_TIMINGS'):
+            with st.sidebar.expander('Render timings'):
+                st.table(pd.Series(self.timings, name = 'seconds'))
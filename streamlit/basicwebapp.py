@@ -1,11 +1,11 @@
 import streamlit as st
 import numpy as np
 import pandas as pd
+from base_app import BaseApp, memoized
 
-np.random.seed(42)
-
-class webpage():
+class webpage(BaseApp):
     def __init__(self, title, stringa, dataframe):
+        super().__init__()
         self.title = title
         self.stringa = stringa
         self.dataframe = dataframe
@@ -22,31 +22,42 @@ class webpage():
         st.write(self.stringa)
         
         # Display the checkbox for hiding/showing the dataframe
-        if st.checkbox("Show related dataframe"):
-            st.dataframe(
-                            self.dataframe,
-                            use_container_width = True
-                        )
-            
-        # Display the linechart
-        st.line_chart(
-                            self.dataframe,
-                            x = self.dataframe.columns[0],
-                            y = self.dataframe.columns[1:-1]
-                     )
+        with self.render('dataframe'):
+            if st.checkbox("Show related dataframe"):
+                st.dataframe(
+                                self.dataframe,
+                                use_container_width = True
+                            )
+
+        # Display the linechart, downsampled when the dataframe is large
+        with self.render('line chart'):
+            self.line_chart(
+                                self.dataframe,
+                                x = self.dataframe.columns[0],
+                                y = self.dataframe.columns[1:-1]
+                           )
 
-toy_dataframe = pd.DataFrame({'Date': pd.date_range(start = "2022-01-01",
-                                                    end = "2022-01-10",
-                                                    freq = "D"),
-                              'Numbers1': np.random.randint(0, 50, size = 10),
-                              'Numbers2': np.random.randint(50, 80, size = 10),
-                              'Letters': ["A", "B", "C", "A", "B", "C","A", "B", "C", "A"]})
+    def run(self):
+        self.stampa()
 
+@memoized(max_entries = 1)
+def toy_dataframe():
+    """
+    Build the dataframe once per process instead of on every rerun
+    """
+    np.random.seed(42)
+    return pd.DataFrame({'Date': pd.date_range(start = "2022-01-01",
+                                               end = "2022-01-10",
+                                               freq = "D"),
+                         'Numbers1': np.random.randint(0, 50, size = 10),
+                         'Numbers2': np.random.randint(50, 80, size = 10),
+                         'Letters': ["A", "B", "C", "A", "B", "C","A", "B", "C", "A"]})
 
-paginaweb = webpage(
-    title = "That's the title",
-    stringa = "That's the stringa",
-    dataframe = toy_dataframe
-    )
+if __name__ == '__main__':
+    paginaweb = webpage(
+        title = "That's the title",
+        stringa = "That's the stringa",
+        dataframe = toy_dataframe()
+        )
 
-paginaweb.stampa()
+    paginaweb.main()
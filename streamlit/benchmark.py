@@ -0,0 +1,361 @@
+""" Benchmark the Streamlit apps headless, run it as `python benchmark.py` from this directory """
+import os
+import asyncio
+import contextlib
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+from streamlit.testing.v1 import AppTest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+@contextlib.contextmanager
+def environment(variables: dict):
+    """ Set environment variables, e.g. the fixtures of an app, and restore them afterwards """
+    previous = {key: os.environ.get(key) for key in variables}
+    os.environ.update(variables)
+    try:
+        yield
+    finally:
+        for key, value in previous.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+
+def bench_iris(reruns = 50):
+    """ Reruns per second of the Iris app while a slider moves, and the model cost of one rerun before and after caching """
+    from IRISClf_Webapp_OOP import MachineLearningModel
+
+    features = {'sepal_length': 5.4, 'sepal_width': 3.4, 'petal_length': 1.3, 'petal_width': 0.2}
+    dataframe = pd.DataFrame(features, index = [0])
+    start = time.perf_counter()
+    for _ in range(5):
+        # What each rerun used to do
+        model = MachineLearningModel()
+        model.model_run()
+        model.predict(dataframe)
+        model.predict(dataframe)
+    retrain_time = (time.perf_counter() - start) / 5
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'model.joblib')
+        model = MachineLearningModel.load_or_train(path)
+        start = time.perf_counter()
+        MachineLearningModel.load_or_train(path)
+        load_time = time.perf_counter() - start
+
+    model.warm_up()
+    start = time.perf_counter()
+    model.predict(dataframe)
+    predict_time = time.perf_counter() - start
+    model.predict_one(features)
+    start = time.perf_counter()
+    for _ in range(1000):
+        model.predict_one(features)
+    cached_time = (time.perf_counter() - start) / 1000
+
+    print(f"retrain and predict twice: {retrain_time * 1000:8.1f} ms")
+    print(f"load the persisted model:  {load_time * 1000:8.1f} ms")
+    print(f"predict:                   {predict_time * 1000:8.1f} ms")
+    print(f"cached prediction:         {cached_time * 1e6:8.1f} us")
+
+    # The whole script, as a session sees it
+    with tempfile.TemporaryDirectory() as directory, environment({'IRIS_MODEL': os.path.join(directory, 'model.joblib')}):
+        app = AppTest.from_file(os.path.join(HERE, 'IRISClf_Webapp_OOP.py'), default_timeout = 60).run()
+        values = np.round(np.linspace(4.3, 7.9, 37), 1)
+        start = time.perf_counter()
+        for i in range(reruns):
+            app.sidebar.slider[0].set_value(float(values[i % len(values)])).run()
+        elapsed = time.perf_counter() - start
+    print(f"app: {reruns / elapsed:.1f} reruns/s ({elapsed / reruns * 1000:.1f} ms per rerun)")
+
+def bench_iris_batch(n_rows = 1_000_000, chunksize = 100_000):
+    """ Rows per second of the chunked csv scoring, on random flowers, for one thread and all of them """
+    from IRISClf_Webapp_OOP import FEATURES, MachineLearningModel
+
+    model = MachineLearningModel()
+    model.model_run()
+    rng = np.random.default_rng(0)
+    flowers = pd.DataFrame(rng.uniform([4.3, 2.0, 1.0, 0.1], [7.9, 4.4, 6.9, 2.5], (n_rows, 4)).round(1), columns = FEATURES)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'flowers.csv')
+        flowers.to_csv(path, index = False)
+        for n_jobs in [1, -1]:
+            start = time.perf_counter()
+            scored = sum(len(chunk) for chunk in model.predict_csv(path, chunksize, n_jobs))
+            elapsed = time.perf_counter() - start
+            print(f"n_jobs {n_jobs:2d}: {scored / elapsed:,.0f} rows/s")
+
+def bench_iris_microbatch(requests = 2000):
+    """ Latency of concurrent single flower requests, scored one by one or gathered by the MicroBatcher """
+    from IRISClf_Webapp_OOP import FEATURES, MachineLearningModel, MicroBatcher
+
+    model = MachineLearningModel()
+    model.model_run()
+    rng = np.random.default_rng(0)
+    flowers = [dict(zip(FEATURES, row)) for row in rng.uniform([4.3, 2.0, 1.0, 0.1], [7.9, 4.4, 6.9, 2.5], (requests, 4))]
+
+    async def one_by_one():
+        loop = asyncio.get_running_loop()
+        return await asyncio.gather(*(loop.run_in_executor(None, model.predict, pd.DataFrame([flower])) for flower in flowers))
+
+    async def batched():
+        async with MicroBatcher(model) as batcher:
+            return await asyncio.gather(*(batcher.predict(flower) for flower in flowers))
+
+    results = {}
+    for label, serve in [('one by one', one_by_one), ('micro-batched', batched)]:
+        start = time.perf_counter()
+        results[label] = np.vstack(asyncio.run(serve()))
+        elapsed = time.perf_counter() - start
+        print(f"{label:14s} {requests / elapsed:10,.0f} requests/s")
+    print(f"same probabilities: {np.allclose(results['one by one'], results['micro-batched'])}")
+
+NBA_TEAMS = ['ATL', 'BOS', 'CHI', 'DAL', 'DEN', 'DET', 'GSW', 'HOU', 'LAL', 'MIA', 'MIL', 'NYK', 'PHI', 'PHO', 'SAS', 'TOT']
+NBA_POSITIONS = ['C', 'PF', 'PG', 'SF', 'SG']
+NBA_STATS = ['G', 'GS', 'MP', 'FG', 'FGA', 'FG%', '3P', '3PA', '3P%', '2P', '2PA', '2P%', 'eFG%', 'FT', 'FTA', 'FT%',
+             'ORB', 'DRB', 'TRB', 'AST', 'STL', 'BLK', 'TOV', 'PF', 'PTS']
+
+def write_nba_fixtures(directory, years = range(1950, 2020), players = 500, seed = 0):
+    """
+    Write random seasons shaped like the basketball-reference tables, header rows repeated every 20 players
+    and missing percentages included, as NBA_<year>_per_game.csv files for the LocalSource
+    """
+    os.makedirs(directory, exist_ok = True)
+    rng = np.random.default_rng(seed)
+    names = [f"Player {i}" for i in range(players * 3)]
+    for year in years:
+        n = players
+        season = pd.DataFrame({'Rk': np.arange(1, n + 1),
+                               'Player': rng.choice(names, n, replace = False),
+                               'Pos': rng.choice(NBA_POSITIONS, n),
+                               'Age': rng.integers(19, 40, n),
+                               'Tm': rng.choice(NBA_TEAMS, n)})
+        for stat in NBA_STATS:
+            values = rng.gamma(2, 0.25 if stat.endswith('%') else 5, n).round(3 if stat.endswith('%') else 1)
+            if stat.endswith('%'):
+                values[rng.random(n) < 0.05] = np.nan
+            season[stat] = values
+        season = season.astype(object)
+        # The table of the website repeats its header
+        header = pd.DataFrame([season.columns], columns = season.columns)
+        parts = [pd.concat([season.iloc[i:i + 20], header]) for i in range(0, n, 20)]
+        pd.concat(parts).to_csv(os.path.join(directory, f"NBA_{year}_per_game.csv"), index = False)
+
+def bench_nba(years = range(1950, 2020), latency = 0.05):
+    """ Season loads from the source, the disk and the memory, and the prefetch of all the seasons with more workers """
+    from nba_store import LocalSource, SeasonStore
+
+    class SlowSource(LocalSource):
+        # A local source with the latency of a request
+        def season(self, year):
+            time.sleep(latency)
+            return super().season(year)
+
+    with tempfile.TemporaryDirectory() as directory:
+        fixtures = os.path.join(directory, 'fixtures')
+        write_nba_fixtures(fixtures, years)
+        source = SlowSource(fixtures)
+
+        store = SeasonStore(os.path.join(directory, 'store'), source)
+        timings = {}
+        for label in ['source', 'memory']:
+            start = time.perf_counter()
+            store.season(years[0])
+            timings[label] = time.perf_counter() - start
+        store = SeasonStore(store.root, source)
+        start = time.perf_counter()
+        store.season(years[0])
+        timings['disk'] = time.perf_counter() - start
+        for label in ['source', 'disk', 'memory']:
+            print(f"season from {label:6s}: {timings[label] * 1000:8.3f} ms")
+
+        for max_workers in [1, 4, 16]:
+            store = SeasonStore(os.path.join(directory, f'prefetch_{max_workers}'), source)
+            start = time.perf_counter()
+            errors = store.prefetch(years, max_workers)
+            print(f"prefetch of {len(years)} seasons, {max_workers:2d} workers: {time.perf_counter() - start:.2f} s, {len(errors)} errors")
+
+def bench_nba_query(years = range(1950, 2020), repeat = 20):
+    """ Top 10 by points per year for two teams and positions, over the seasons one by one and on the MultiSeasonTable """
+    from nba_store import LocalSource, SeasonStore
+    from nba_query import MultiSeasonTable
+
+    teams, positions = ['BOS', 'LAL'], ['C', 'PF']
+    with tempfile.TemporaryDirectory() as directory:
+        write_nba_fixtures(os.path.join(directory, 'fixtures'), years)
+        store = SeasonStore(os.path.join(directory, 'store'), LocalSource(os.path.join(directory, 'fixtures')), maxsize = len(years))
+        store.prefetch(years)
+
+        start = time.perf_counter()
+        for _ in range(repeat):
+            seasons = []
+            for year in years:
+                df = store.season(year)
+                df = df[df['Tm'].isin(teams) & df['Pos'].isin(positions)]
+                seasons.append(df.sort_values('PTS', ascending = False).head(10).assign(Year = year))
+            expected = pd.concat(seasons)
+        seasons_time = (time.perf_counter() - start) / repeat
+
+        path = os.path.join(directory, 'all_seasons.parquet')
+        start = time.perf_counter()
+        table = MultiSeasonTable.from_store(store, years, path)
+        build_time = time.perf_counter() - start
+        start = time.perf_counter()
+        MultiSeasonTable.from_store(store, years, path)
+        load_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for _ in range(repeat):
+            top = table.top('PTS', 10, years, teams, positions)
+        table_time = (time.perf_counter() - start) / repeat
+
+    print(f"{len(table):,} player seasons, {table.data.memory_usage(deep = True).sum() / 2**20:.1f} MiB")
+    print(f"build the table: {build_time:.2f} s, load it: {load_time:.2f} s")
+    print(f"season by season (in memory): {seasons_time * 1000:7.1f} ms")
+    print(f"table:                        {table_time * 1000:7.1f} ms ({seasons_time / table_time:.0f}x)")
+    print(f"same players: {sorted(zip(expected['Year'], expected['Player'])) == sorted(zip(top['Year'], top['Player']))}")
+
+UFO_COLUMNS = ['datetime', 'city', 'state', 'country', 'shape', 'duration (seconds)', 'duration (hours/min)',
+               'comments', 'date posted', 'latitude', 'longitude ']
+
+def write_ufo_fixture(path, rows = 80_000, seed = 0):
+    """
+    Write random reports shaped like complete.csv: month first dates with some 24:00 times, a few malformed dates,
+    coordinates with typos and lines with extra fields
+    """
+    rng = np.random.default_rng(seed)
+    dates = pd.Timestamp('1949-10-10') + pd.to_timedelta(rng.integers(0, 64 * 365 * 24 * 60, rows), unit = 'min')
+    datetimes = pd.Series(dates.month.astype(str) + '/' + dates.day.astype(str) + '/' + dates.year.astype(str) + ' ' +
+                          dates.strftime('%H:%M'))
+    midnight = dates.hour == 0
+    datetimes[midnight] = (dates[midnight] - pd.Timedelta(days = 1)).strftime('%-m/%-d/%Y') + ' 24:00'
+    malformed = rng.random(rows) < 0.002
+    datetimes[malformed] = rng.choice(['', '0/0/2000 20:00', '13/45/1999 10:00', 'unknown', '6/15/2005 9:3 pm'], malformed.sum())
+    latitude = rng.uniform(25, 49, rows).round(6).astype(str)
+    latitude[rng.random(rows) < 0.0005] = '33q.200088'
+    reports = pd.DataFrame({'datetime': datetimes,
+                            'city': rng.choice(['seattle', 'phoenix', 'portland', 'las vegas', 'los angeles', 'san diego'], rows),
+                            'state': rng.choice(['wa', 'az', 'or', 'nv', 'ca'], rows),
+                            'country': rng.choice(['us', 'ca', 'gb'], rows, p = [0.9, 0.05, 0.05]),
+                            'shape': rng.choice(['light', 'triangle', 'circle', 'fireball', 'disk', 'other'], rows),
+                            'duration (seconds)': rng.integers(1, 3600, rows),
+                            'duration (hours/min)': rng.choice(['5 minutes', '1 hour', '30 seconds', '10 min'], rows),
+                            'comments': rng.choice(['Bright light moving fast', 'Three lights in a triangle', 'Orange orb'], rows),
+                            'date posted': rng.choice(['4/27/2004', '12/12/2009', '5/14/2012'], rows),
+                            'latitude': latitude,
+                            'longitude ': rng.uniform(-124, -67, rows).round(6)},
+                           columns = UFO_COLUMNS)
+    reports.to_csv(path, index = False)
+    # A few lines of the dump have more fields than the header
+    with open(path, 'a') as file:
+        file.write('10/10/1999 20:00,city,tx,us,light,60,1 min,comma, in the comments,1/1/2000,30.1,-97.1,extra\n' * 3)
+
+def bench_ufo(rows = 80_000, repeat = 24):
+    """ Loading the reports from the csv and from the parquet cache, and filtering an hour by scanning or with the index """
+    from base_app import downsample_points
+    from ufo_data import ReportIndex, load_reports, normalization_report
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'complete.csv')
+        write_ufo_fixture(path, rows)
+        timings = {}
+        for label in ['csv', 'parquet']:
+            start = time.perf_counter()
+            data = load_reports(path)
+            timings[label] = time.perf_counter() - start
+        print(f"{len(data):,} reports, {data.memory_usage(deep = True).sum() / 2**20:.1f} MiB")
+        print(f"load from csv:     {timings['csv']:.2f} s")
+        print(f"load from parquet: {timings['parquet']:.2f} s")
+        report = normalization_report(path)
+        print(f"normalized {report['rows']:,} rows at {report['rows_per_second']:,.0f} rows/s, "
+              f"{report['fallback']:,} by the fallback, {report['quarantined']:,} quarantined, {report['fields']:,} of them for their fields")
+
+        start = time.perf_counter()
+        for hour in range(repeat):
+            scanned = data[data['datetime'].dt.hour == hour % 24]
+            np.histogram(data['datetime'].dt.hour, bins = 24, range = (0, 24))
+        scan_time = (time.perf_counter() - start) / repeat
+        index = ReportIndex(data)
+        start = time.perf_counter()
+        for hour in range(repeat):
+            indexed = index.select(hour % 24)
+            index.hour_counts()
+        index_time = (time.perf_counter() - start) / repeat
+        print(f"hour filter and histogram, scan:  {scan_time * 1000:6.2f} ms")
+        print(f"hour filter and histogram, index: {index_time * 1000:6.2f} ms ({scan_time / index_time:.0f}x), same rows {scanned.equals(indexed)}")
+
+        start = time.perf_counter()
+        points = downsample_points(data)
+        print(f"map of all the reports: {len(points):,} points in {(time.perf_counter() - start) * 1000:.1f} ms")
+
+def _nba_fixtures(directory):
+    write_nba_fixtures(os.path.join(directory, 'nba'), players = 300)
+    return {'NBA_LOCAL': os.path.join(directory, 'nba'), 'NBA_STORE': os.path.join(directory, 'nba_store')}
+
+def _ufo_fixtures(directory):
+    write_ufo_fixture(os.path.join(directory, 'complete.csv'))
+    return {'UFO_DATA': os.path.join(directory, 'complete.csv')}
+
+def _all_seasons(app, i):
+    if app.sidebar.radio[0].value != 'All seasons':
+        # The first action switches the view, and builds the table of all the seasons
+        app.sidebar.radio[0].set_value('All seasons')
+        return
+    app.sidebar.selectbox[0].set_value(['PTS', 'AST', 'TRB'][i % 3])
+    app.sidebar.multiselect[0].set_value(['BOS'] if i % 2 else [])
+
+# For each app: the script, the fixtures it reads, as environment variables, and the user action before each rerun
+APPS = {
+    'basic': ('basicwebapp.py', lambda directory: {},
+              lambda app, i: app.checkbox[0].set_value(i % 2 == 0)),
+    'iris': ('IRISClf_Webapp_OOP.py', lambda directory: {'IRIS_MODEL': os.path.join(directory, 'iris.joblib')},
+             lambda app, i: app.sidebar.slider[i % 4].set_value(app.sidebar.slider[i % 4].min + 0.1 * (i % 10))),
+    'nba season': ('NBADash_OOP.py', _nba_fixtures,
+                   lambda app, i: app.sidebar.selectbox[0].set_value(2019 - i % 5)),
+    'nba all seasons': ('NBADash_OOP.py', _nba_fixtures, _all_seasons),
+    'ufo': ('ufoapp_OOP.py', _ufo_fixtures,
+            lambda app, i: app.sidebar.slider[0].set_value(i % 24)),
+}
+
+def rerun_latencies(script, interact, reruns = 30, timeout = 120):
+    """
+    Run an app headless with AppTest, then apply reruns user actions, and return the time of the first run,
+    the latency of each rerun and the render timings of the last one
+    """
+    app = AppTest.from_file(os.path.join(HERE, script), default_timeout = timeout)
+    start = time.perf_counter()
+    app.run()
+    first = time.perf_counter() - start
+    latencies = []
+    for i in range(reruns):
+        interact(app, i)
+        start = time.perf_counter()
+        app.run()
+        latencies.append(time.perf_counter() - start)
+        if app.exception:
+            raise RuntimeError(f"{script}: {app.exception[0].message}")
+    timings = app.session_state['render_timings'] if 'render_timings' in app.session_state else {}
+    return first, np.array(latencies), timings
+
+def bench_reruns(reruns = 30, apps = APPS):
+    """ Rerun latency percentiles of every app, driven by AppTest on local fixtures, without network """
+    with tempfile.TemporaryDirectory() as directory:
+        print(f"{'app':16s} {'first':>8s} {'p50':>8s} {'p90':>8s} {'p99':>8s} {'max':>8s}  (ms)")
+        for name, (script, fixtures, interact) in apps.items():
+            with environment(fixtures(directory)):
+                first, latencies, timings = rerun_latencies(script, interact, reruns)
+            p50, p90, p99 = np.percentile(latencies, [50, 90, 99]) * 1000
+            print(f"{name:16s} {first * 1000:8.1f} {p50:8.1f} {p90:8.1f} {p99:8.1f} {latencies.max() * 1000:8.1f}")
+            print(' ' * 17 + ', '.join(f"{section} {seconds * 1000:.1f}" for section, seconds in timings.items()))
+
+if __name__ == '__main__':
+    bench_iris()
+    bench_iris_batch()
+    bench_iris_microbatch()
+    bench_nba()
+    bench_nba_query()
+    bench_ufo()
+    bench_reruns()
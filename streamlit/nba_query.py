@@ -0,0 +1,133 @@
+""" Queries over all the NBA seasons at once, on a single columnar table with indexes by team, position and player """
+import os
+import numpy as np
+import pandas as pd
+from nba_store import FIRST_YEAR, LAST_YEAR
+
+# The text columns, stored as categories, and the ones which get an index
+CATEGORICAL = ['Player', 'Pos', 'Tm']
+INDEXED = ['Tm', 'Pos', 'Player']
+
+class CategoryIndex():
+    """
+    The rows of each category of a categorical column, as one array of row numbers sorted by category
+    and the offsets of each category in it
+    """
+    def __init__(self, column):
+        self.categories = column.cat.categories
+        codes = column.cat.codes.to_numpy()
+        self.order = np.argsort(codes, kind = 'stable')
+        self.offsets = np.searchsorted(codes[self.order], np.arange(len(self.categories) + 1))
+
+    def rows(self, values):
+        """
+        Return the sorted rows of the values, the unknown values have no rows
+        """
+        codes = self.categories.get_indexer(list(values))
+        codes = codes[codes >= 0]
+        return np.sort(np.concatenate([self.order[self.offsets[code]:self.offsets[code + 1]] for code in codes] + [np.array([], dtype = np.intp)]))
+
+class MultiSeasonTable():
+    """
+    The per game statistics of many seasons in one dataframe sorted by year, with a Year column, the text
+    columns as categories and the statistics as float32. The stats a season did not record, e.g. 3P before 1980,
+    are nan. Filters on the years, teams, positions and players take their rows from the indexes instead of
+    comparing strings
+    """
+    def __init__(self, dataframe):
+        self.data = dataframe.sort_values('Year', kind = 'stable').reset_index(drop = True)
+        self.years = self.data['Year'].to_numpy()
+        self.indexes = {column: CategoryIndex(self.data[column]) for column in INDEXED}
+        self.stats = [column for column in self.data.columns if column not in CATEGORICAL + ['Year']]
+
+    def __len__(self):
+        return len(self.data)
+
+    @classmethod
+    def from_seasons(cls, seasons: dict):
+        """
+        Build the table from {year: cleaned season}, as returned by SeasonStore.season
+        """
+        frames = [season.assign(Year = year) for year, season in seasons.items()]
+        data = pd.concat(frames, ignore_index = True)
+        data['Year'] = data['Year'].astype(np.int16)
+        for column in data.columns:
+            if column in CATEGORICAL:
+                data[column] = data[column].astype(str).astype('category')
+            elif column != 'Year':
+                data[column] = pd.to_numeric(data[column], errors = 'coerce').astype(np.float32)
+        return cls(data)
+
+    @classmethod
+    def from_store(cls, store, years = range(FIRST_YEAR, LAST_YEAR + 1), path = None):
+        """
+        Build the table from the seasons of a SeasonStore. With a path, the table is also kept in one parquet
+        file, which is read instead as long as it is newer than all the seasons in the store
+        """
+        if path is not None and os.path.exists(path):
+            table = cls(pd.read_parquet(path))
+            newest = max((store.modified(year) for year in years if not store.expired(year)), default = 0)
+            if set(years) <= set(table.years.tolist()) and os.path.getmtime(path) >= newest:
+                return table.select(years = years)
+        table = cls.from_seasons({year: store.season(year) for year in years})
+        if path is not None:
+            table.data.to_parquet(path + '.tmp')
+            os.replace(path + '.tmp', path)
+        return table
+
+    def select(self, years = None):
+        """
+        Return a table with only the seasons of years
+        """
+        return MultiSeasonTable(self.data.iloc[self.rows(years = years)])
+
+    def rows(self, years = None, teams = None, positions = None, players = None):
+        """
+        Return the sorted rows of the players of the years, teams, positions and players, None keeps them all
+        """
+        rows = np.arange(len(self.data))
+        if years is not None:
+            years = np.unique(list(years))
+            # The rows are sorted by year, each year is a slice
+            starts = np.searchsorted(self.years, years, 'left')
+            ends = np.searchsorted(self.years, years, 'right')
+            rows = np.concatenate([np.arange(start, end) for start, end in zip(starts, ends)] + [np.array([], dtype = np.intp)])
+        for column, values in zip(INDEXED, [teams, positions, players]):
+            if values is not None:
+                rows = np.intersect1d(rows, self.indexes[column].rows(values), assume_unique = True)
+        return rows
+
+    def query(self, years = None, teams = None, positions = None, players = None, columns = None):
+        """
+        Return the statistics of the selected rows
+        """
+        data = self.data.iloc[self.rows(years, teams, positions, players)]
+        return data if columns is None else data[columns]
+
+    def career(self, player, stats: list = None):
+        """
+        Return the seasons of a player indexed by year. A player traded during a season has a row per team
+        and a total, TOT, of which only the total is kept
+        """
+        data = self.query(players = [player])
+        data = data[~data['Year'].duplicated(keep = False) | (data['Tm'] == 'TOT')]
+        data = data.set_index('Year')
+        return data if stats is None else data[stats]
+
+    def top(self, stat, n = 10, years = None, teams = None, positions = None):
+        """
+        Return the n players with the highest stat of each year, among the selected teams and positions
+        """
+        data = self.query(years, teams, positions)
+        values = data[stat].to_numpy()
+        # Sort by year, then by the stat from the highest, and keep the first n of each year
+        order = np.lexsort((np.nan_to_num(-values, nan = np.inf), data['Year'].to_numpy()))
+        data = data.iloc[order]
+        return data[data.groupby('Year').cumcount().to_numpy() < n]
+
+    def aggregate(self, stat, by = 'Tm', agg = 'mean', years = None, teams = None, positions = None):
+        """
+        Return the aggregate of a stat of the selected rows, with a row per year and a column per value of by
+        """
+        data = self.query(years, teams, positions)
+        return data.groupby(['Year', by], observed = True)[stat].agg(agg).unstack(by)
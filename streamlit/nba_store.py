@@ -0,0 +1,201 @@
+""" Cache of the NBA per game statistics, one season at a time, in memory and on disk """
+import argparse
+import collections
+import concurrent.futures
+import os
+import threading
+import time
+import pandas as pd
+
+FIRST_YEAR = 1950
+LAST_YEAR = 2019
+# Seconds between two requests of a worker to basketball-reference, which limits the requests per minute
+FETCH_DELAY = 3
+
+def clean_season(df):
+    """
+    Drop the header rows repeated inside the table and the rank, and give the numeric columns a numeric dtype
+    """
+    raw = df.drop(df[df.Age == 'Age'].index)
+    for column in raw.columns:
+        try:
+            raw[column] = pd.to_numeric(raw[column])
+        except (ValueError, TypeError):
+            pass
+    # The text columns are filled with text, so that each column keeps a single type in parquet
+    raw = raw.fillna({column: 0 if pd.api.types.is_numeric_dtype(raw[column]) else '' for column in raw.columns})
+    return raw.drop(['Rk'], axis = 1).reset_index(drop = True)
+
+class Source():
+    """
+    Where the seasons come from
+    """
+    def season(self, year):
+        """
+        Return the raw table of the per game statistics of a season
+        """
+        raise NotImplementedError
+
+class BasketballReferenceSource(Source):
+    def __init__(self, url = "https://www.basketball-reference.com/leagues/NBA_{year}_per_game.html"):
+        self.url = url
+
+    def season(self, year):
+        return pd.read_html(self.url.format(year = year), header = 0)[0]
+
+class LocalSource(Source):
+    """
+    Read the seasons from a directory of saved pages, NBA_<year>_per_game.html, or of csv files, NBA_<year>_per_game.csv,
+    so that the app runs without network
+    """
+    def __init__(self, directory):
+        self.directory = directory
+
+    def season(self, year):
+        path = os.path.join(self.directory, f"NBA_{year}_per_game")
+        if os.path.exists(path + '.csv'):
+            return pd.read_csv(path + '.csv')
+        if os.path.exists(path + '.html'):
+            return pd.read_html(path + '.html', header = 0)[0]
+        raise FileNotFoundError(f"No season {year} in {self.directory}")
+
+class SeasonStore():
+    """
+    Serve the cleaned seasons from a LRU of the last maxsize seasons in memory, then from one parquet file
+    per season on disk, and only then from the source. A file older than ttl seconds is fetched again,
+    with ttl None the files never expire, and is still served if the source fails. The store is thread safe,
+    a season is fetched by one thread at a time, so one store can serve every session of the app; the
+    dataframes it returns are shared and must not be modified
+    """
+    def __init__(self, root, source = None, ttl = 30*24*3600, maxsize = 16):
+        self.root = root
+        self.source = source or BasketballReferenceSource()
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.memory = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.year_locks = collections.defaultdict(threading.RLock)
+        os.makedirs(self.root, exist_ok = True)
+
+    def __str__(self):
+        return f"NBA season store in {self.root} with {len(self.stored())} seasons on disk"
+
+    def _path(self, year):
+        return os.path.join(self.root, f"{year}.parquet")
+
+    def _year_lock(self, year):
+        with self.lock:
+            return self.year_locks[year]
+
+    def expired(self, year):
+        """
+        Whether the season is not on disk, or is older than the ttl
+        """
+        path = self._path(year)
+        if not os.path.exists(path):
+            return True
+        return self.ttl is not None and time.time() - self.modified(year) > self.ttl
+
+    def modified(self, year):
+        """
+        Return when the season was written to disk, as a timestamp
+        """
+        return os.path.getmtime(self._path(year))
+
+    def stored(self):
+        """
+        Return the seasons on disk which are not expired
+        """
+        years = [int(name[:-len('.parquet')]) for name in os.listdir(self.root) if name.endswith('.parquet')]
+        return sorted(year for year in years if not self.expired(year))
+
+    def fetch(self, year):
+        """
+        Take the season from the source and write it to disk, replacing the file only once it is complete
+        """
+        with self._year_lock(year):
+            season = clean_season(self.source.season(year))
+            path = self._path(year)
+            # A temporary file per thread, a prefetch in another process may write the same season
+            temporary = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            season.to_parquet(temporary)
+            os.replace(temporary, path)
+            return season
+
+    def season(self, year):
+        """
+        Return the cleaned statistics of a season
+        """
+        with self.lock:
+            if year in self.memory:
+                self.memory.move_to_end(year)
+                return self.memory[year]
+        with self._year_lock(year):
+            with self.lock:
+                # Another session may have loaded it while this one waited
+                if year in self.memory:
+                    return self.memory[year]
+            season = self._load(year)
+        with self.lock:
+            self.memory[year] = season
+            self.memory.move_to_end(year)
+            while len(self.memory) > self.maxsize:
+                self.memory.popitem(last = False)
+        return season
+
+    def _load(self, year):
+        path = self._path(year)
+        if not self.expired(year):
+            return pd.read_parquet(path)
+        try:
+            return self.fetch(year)
+        except Exception:
+            # An expired season is better than none, e.g. when the app runs offline
+            if os.path.exists(path):
+                return pd.read_parquet(path)
+            raise
+
+    def evict_expired(self):
+        """
+        Delete the files older than the ttl, and forget all the seasons in memory
+        """
+        with self.lock:
+            self.memory.clear()
+        for name in os.listdir(self.root):
+            if name.endswith('.parquet') and self.expired(int(name[:-len('.parquet')])):
+                os.remove(os.path.join(self.root, name))
+
+    def prefetch(self, years = range(FIRST_YEAR, LAST_YEAR + 1), max_workers = 4, delay = 0):
+        """
+        Fetch the missing or expired seasons, at most max_workers at a time, each worker waiting delay seconds
+        after a request to respect the rate limit of the source. Return {year: error} for the failed seasons
+        """
+        def fetch(year):
+            try:
+                self.fetch(year)
+            finally:
+                time.sleep(delay)
+
+        errors = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers = max_workers) as pool:
+            futures = {pool.submit(fetch, year): year for year in years if self.expired(year)}
+            for future in concurrent.futures.as_completed(futures):
+                if future.exception() is not None:
+                    errors[futures[future]] = future.exception()
+        return errors
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Download the NBA seasons to the store of the app")
+    parser.add_argument('root', help = "directory of the store")
+    parser.add_argument('--first', type = int, default = FIRST_YEAR)
+    parser.add_argument('--last', type = int, default = LAST_YEAR)
+    parser.add_argument('--workers', type = int, default = 4)
+    parser.add_argument('--delay', type = float, default = FETCH_DELAY, help = "seconds between two requests of a worker")
+    parser.add_argument('--local', help = "read the seasons from this directory instead of basketball-reference")
+    args = parser.parse_args()
+
+    store = SeasonStore(args.root, LocalSource(args.local) if args.local else None)
+    errors = store.prefetch(range(args.first, args.last + 1), args.workers, args.delay)
+    print(store)
+    for year, error in sorted(errors.items()):
+        print(f"{year}: {error}")
@@ -0,0 +1,188 @@
+""" Loading and indexing of the NUFORC reports, complete.csv from https://www.kaggle.com/datasets/NUFORC/ufo-sightings """
+import json
+import os
+import re
+import time
+import numpy as np
+import pandas as pd
+
+# The columns of complete.csv and their narrowest dtype, the text columns with few values are categories
+CATEGORIES = ['city', 'state', 'country', 'shape', 'duration (hours/min)', 'date posted']
+NUMBERS = ['duration (seconds)', 'latitude', 'longitude']
+
+# The version of the preprocessing, see _fingerprint
+CACHE_VERSION = 2
+
+# The format of almost all the dates of the dump, month first
+DATETIME_FORMAT = '%m/%d/%Y %H:%M'
+# The other dates which can still be read: two digit years, dashes, seconds, am/pm or no time at all
+IRREGULAR_DATETIME = re.compile(r'^(\d{1,2})[/-](\d{1,2})[/-](\d{4}|\d{2})'
+                                r'(?:\s+(\d{1,2})(?::(\d{1,2}))?(?::(\d{1,2}))?\s*([AaPp][Mm])?)?$')
+
+def read_reports(path, chunksize = 20_000, bad_lines = None):
+    """
+    Read the whole csv chunk by chunk, with the narrow dtypes applied to each chunk, and yield the chunks.
+    The dump has a few lines with extra fields, which are skipped, or appended to the list bad_lines as
+    lists of fields if given, which needs the slower python parser
+    """
+    if bad_lines is None:
+        chunks = pd.read_csv(path, chunksize = chunksize, dtype = str, on_bad_lines = 'skip', low_memory = False)
+    else:
+        chunks = pd.read_csv(path, chunksize = chunksize, dtype = str, on_bad_lines = bad_lines.append, engine = 'python')
+    for chunk in chunks:
+        chunk.columns = chunk.columns.str.strip()
+        for column in NUMBERS:
+            # Some coordinates have typos, e.g. 33q.200088, they become nan
+            chunk[column] = pd.to_numeric(chunk[column], errors = 'coerce').astype(np.float32)
+        yield chunk
+
+def _parse_irregular(strings):
+    """
+    Parse the dates which do not have the usual format, all at once from the fields of a regular expression
+    """
+    fields = strings.str.extract(IRREGULAR_DATETIME)
+    month, day, year, hour, minute, second = (pd.to_numeric(fields[i]) for i in range(6))
+    # Two digit years follow strptime, 69-99 are the 1900s
+    year = year.where(year >= 100, year + np.where(year >= 69, 1900, 2000))
+    # A month above 12 with a day up to 12 is a day first date
+    swap = (month > 12) & (day <= 12)
+    month, day = month.where(~swap, day), day.where(~swap, month)
+    hour, minute, second = hour.fillna(0), minute.fillna(0), second.fillna(0)
+    pm, am = fields[6].str.lower() == 'pm', fields[6].str.lower() == 'am'
+    hour = hour.where(~(pm & (hour < 12)), hour + 12).where(~(am & (hour == 12)), 0)
+    dates = pd.to_datetime(pd.DataFrame({'year': year, 'month': month, 'day': day}), errors = 'coerce')
+    valid = (hour <= 24) & (minute < 60) & (second < 60)
+    # 24:00 is midnight of the next day
+    times = pd.to_timedelta(hour * 3600 + minute * 60 + second, unit = 's')
+    return (dates + times).where(valid)
+
+def parse_datetimes(strings):
+    """
+    Return the datetimes of the strings, and which ones needed the fallback. The usual format is parsed first,
+    with "24:00" as "00:00" of the next day, then the other strings go through _parse_irregular. The strings which
+    do not parse either are NaT
+    """
+    strings = strings.fillna('').str.strip()
+    twenty_fours = strings.str.endswith(' 24:00')
+    fixed = strings.where(~twenty_fours, strings.str[:-5] + '00:00')
+    datetimes = pd.to_datetime(fixed, format = DATETIME_FORMAT, errors = 'coerce')
+    datetimes[twenty_fours] += pd.Timedelta(days = 1)
+    fallback = datetimes.isna() & (strings != '')
+    if fallback.any():
+        datetimes[fallback] = _parse_irregular(strings[fallback])
+    return datetimes, fallback
+
+def preprocess_reports(data):
+    """
+    Parse the date time column, and split the reports into the ones with a datetime and the quarantined ones,
+    whose datetime could not be read, kept with their original string. Return them with the counts of the chunk
+    """
+    datetimes, fallback = parse_datetimes(data['datetime'])
+    parsed = datetimes.notna()
+    quarantined = data[~parsed].assign(reason = 'datetime')
+    data = data[parsed].assign(datetime = datetimes[parsed])
+    counts = {'rows': len(parsed), 'fallback': int((fallback & parsed).sum()), 'quarantined': int((~parsed).sum())}
+    return data, quarantined, counts
+
+def quarantine_lines(bad_lines, columns):
+    """
+    Return the lines with a wrong number of fields as quarantined reports: the first fields in the columns,
+    the extra ones joined in an extra column
+    """
+    n = len(columns)
+    rows = [fields[:n] + [None] * (n - len(fields)) for fields in bad_lines]
+    extra = [','.join(fields[n:]) for fields in bad_lines]
+    return pd.DataFrame(rows, columns = columns, dtype = str).assign(reason = 'fields', extra = extra)
+
+def _fingerprint(path):
+    stat = os.stat(path)
+    # The version changes with the preprocessing, so that the caches of an older one are written again
+    return {'source': os.path.abspath(path), 'size': stat.st_size, 'mtime': stat.st_mtime, 'version': CACHE_VERSION}
+
+def _cache_paths(path):
+    return path + '.parquet', path + '.parquet.json', path + '.quarantine.csv'
+
+def normalization_report(path):
+    """
+    Return the report of the normalization of the csv, if it is cached and the csv has not changed
+    """
+    meta_path = _cache_paths(path)[1]
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path) as file:
+        meta = json.load(file)
+    return meta['report'] if meta['source'] == _fingerprint(path) else None
+
+def load_reports(path, cache = True, chunksize = 20_000):
+    """
+    Return all the reports of the csv, preprocessed, with narrow dtypes and sorted by datetime. The first load
+    writes them to <path>.parquet, the quarantined reports, whose datetime or number of fields is wrong, to
+    <path>.quarantine.csv and the normalization report, with its rows per second, to <path>.parquet.json.
+    The next loads read the parquet file as long as the csv has not changed, so the preprocessing runs once
+    per source file
+    """
+    cache_path, meta_path, quarantine_path = _cache_paths(path)
+    if cache and os.path.exists(cache_path) and normalization_report(path) is not None:
+        return pd.read_parquet(cache_path)
+
+    start = time.perf_counter()
+    frames, quarantined, report = [], [], {'rows': 0, 'fallback': 0, 'quarantined': 0}
+    bad_lines = []
+    for chunk in read_reports(path, chunksize, bad_lines):
+        data, bad, counts = preprocess_reports(chunk)
+        frames.append(data)
+        quarantined.append(bad)
+        report = {key: report[key] + counts[key] for key in report}
+    # The lines with a wrong number of fields are rows of the file too, quarantined as a whole
+    quarantined.append(quarantine_lines(bad_lines, list(frames[0].columns)))
+    report['fields'] = len(bad_lines)
+    report['rows'] += len(bad_lines)
+    report['quarantined'] += len(bad_lines)
+    data = pd.concat(frames, ignore_index = True)
+    # The categories are set on the whole data, so that all the chunks share the same codes
+    for column in CATEGORIES:
+        data[column] = data[column].astype('category')
+    data = data.sort_values('datetime', kind = 'stable').reset_index(drop = True)
+    report['seconds'] = time.perf_counter() - start
+    report['rows_per_second'] = report['rows'] / report['seconds']
+
+    if cache:
+        data.to_parquet(cache_path + '.tmp')
+        os.replace(cache_path + '.tmp', cache_path)
+        pd.concat(quarantined).to_csv(quarantine_path, index = False)
+        # The fingerprint is written last, a parquet file without it is never read
+        with open(meta_path, 'w') as file:
+            json.dump({'source': _fingerprint(path), 'report': report}, file)
+    return data
+
+class ReportIndex():
+    """
+    Buckets of the reports, sorted by datetime, by hour of the day and by date. The rows of an hour are
+    a slice of one array of row numbers, the rows of a date range a slice of the data itself
+    """
+    def __init__(self, data):
+        self.data = data
+        self.datetimes = data['datetime'].to_numpy()
+        hours = data['datetime'].dt.hour.to_numpy()
+        # A stable sort keeps the rows of each hour in datetime order
+        self.order = np.argsort(hours, kind = 'stable')
+        self.offsets = np.searchsorted(hours[self.order], np.arange(25))
+
+    def hour_counts(self):
+        """
+        Return the number of reports of each hour of the day
+        """
+        return np.diff(self.offsets)
+
+    def rows(self, hour = None, start = None, end = None):
+        """
+        Return the sorted rows of the hour, between the dates start (included) and end (excluded), None keeps them all
+        """
+        rows = np.arange(len(self.data)) if hour is None else self.order[self.offsets[hour]:self.offsets[hour + 1]]
+        datetimes = self.datetimes[rows]
+        first = 0 if start is None else np.searchsorted(datetimes, np.datetime64(pd.Timestamp(start)))
+        last = len(rows) if end is None else np.searchsorted(datetimes, np.datetime64(pd.Timestamp(end)))
+        return rows[first:last]
+
+    def select(self, hour = None, start = None, end = None):
+        return self.data.iloc[self.rows(hour, start, end)]
@@ -1,60 +1,74 @@
 # Download "complete.csv" file from https://www.kaggle.com/datasets/NUFORC/ufo-sightings?resource=download
 
+import os
 import streamlit as st
 import numpy as np
 import pandas as pd
+from ufo_data import ReportIndex, load_reports, normalization_report
+from base_app import BaseApp, memoized
 
 np.random.seed(42)
 
-class NUFORCReportApp:
-    def __init__(self):
-        self.data = self.load_data(500)
-        self.data = self.preprocess_data(self.data)        
-    
-    def load_data(self, nrows):
-        data = pd.read_csv("complete.csv", nrows=nrows)
-        return data
-    
-    def preprocess_data(self, data):
-        """
-        Convert strings in the date time column so that when "24:00" appears, change it in "00:00" +1 day
-        """
-        twenty_fours = data['datetime'].str[-5:] == '24:00'
-        data.loc[twenty_fours, 'datetime'] = data['datetime'].str[:-5] + '00:00'
-        data['datetime'] = pd.to_datetime(data['datetime'], format='%d/%m/%Y %H:%M')
-        data.loc[twenty_fours, 'datetime'] += pd.DateOffset(1)
-        return data
-        
+DATA_PATH = os.environ.get('UFO_DATA', "complete.csv")
+
+@memoized(max_entries = 2, max_bytes = 2**30)
+def report_index(path = DATA_PATH):
+    """
+    The reports and their index, loaded once per process and shared by all the sessions
+    """
+    return ReportIndex(load_reports(path))
+
+class NUFORCReportApp(BaseApp):
+    def __init__(self, max_rows = 1000, max_points = 5000):
+        super().__init__(max_map_points = max_points)
+        with self.render('load'):
+            self.index = report_index()
+        self.data = self.index.data
+        # Sending every row to the browser on each rerun is what makes a large table slow, show the first ones
+        self.max_rows = max_rows
+
     def display_raw_data(self):
         st.subheader("Raw Data")
-        st.dataframe(self.data, use_container_width=True)
-        
+        st.write(f"{len(self.data):,} reports, the first {min(self.max_rows, len(self.data)):,} are shown")
+        report = normalization_report(DATA_PATH)
+        if report is not None and report['quarantined']:
+            st.caption(f"{report['quarantined']:,} reports without a readable date or with extra fields are set aside "
+                       f"in {DATA_PATH}.quarantine.csv")
+        st.dataframe(self.data.head(self.max_rows), use_container_width=True)
+
     def display_sighting_report_by_hour(self):
         st.subheader("Number of sighting report by hour")
-        hist_values = np.histogram(self.data["datetime"].dt.hour, bins=24, range=(0, 24))[0]
+        hist_values = self.index.hour_counts()
         st.bar_chart(hist_values)
-        
+
     def display_map_filtered(self, hour_to_filter):
         st.subheader("Map of sightings at {}:00".format(hour_to_filter))
-        st.map(self.data_filtered)
-        
+        self.map(self.data_filtered)
+
     def display_raw_data_filtered(self, hour_to_filter):
         st.subheader("Filtered data by {}:00 ".format(hour_to_filter))
-        st.dataframe(self.data_filtered, use_container_width=True)
-    
+        st.dataframe(self.data_filtered.head(self.max_rows), use_container_width=True)
+
     def run(self):
         st.title("NUFORC Report App")
         st.write("Let's try to build an app regarding UFO seeing")
-        
-        self.display_raw_data()
-        self.display_sighting_report_by_hour()
-        
+
+        with self.render('raw data'):
+            self.display_raw_data()
+        with self.render('histogram'):
+            self.display_sighting_report_by_hour()
+
         hour_to_filter = st.sidebar.slider('hour', 0, 23, 17)
-        self.data_filtered = self.data[self.data["datetime"].dt.hour == hour_to_filter]
-        
-        self.display_map_filtered(hour_to_filter)
-        self.display_raw_data_filtered(hour_to_filter)
+        first, last = self.data['datetime'].iloc[[0, -1]].dt.date
+        start, end = st.sidebar.slider('dates', first, last, (first, last))
+        with self.render('query'):
+            self.data_filtered = self.index.select(hour_to_filter, start, end + pd.Timedelta(days=1))
+
+        with self.render('map'):
+            self.display_map_filtered(hour_to_filter)
+        with self.render('filtered data'):
+            self.display_raw_data_filtered(hour_to_filter)
 
 if __name__ == "__main__":
     app = NUFORCReportApp()
-    app.run()
+    app.main()